@@ -1,5 +1,19 @@
 from .log import *
+from .framing import *
+from .telemetry_store import telemetry_store
+from .tracing import trace, STAGES
+from .startup import startup
+from .fifo_reader import fifo_reader
 
 __all__ = [
-    "log"
+    "log",
+    "frame_encoder",
+    "frame_decoder",
+    "SENSORS",
+    "SENSOR_IDS",
+    "telemetry_store",
+    "trace",
+    "STAGES",
+    "startup",
+    "fifo_reader"
 ]
\ No newline at end of file
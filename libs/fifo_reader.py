@@ -0,0 +1,67 @@
+import os
+
+
+class fifo_reader:
+    """
+    reads a FIFO with one large read into a reusable buffer per call and decodes it, so all the samples the writer
+    queued in the meantime come back as one batch and the caller can apply them and render once. When the writer
+    closes the FIFO (EOF) the next call opens it again, waiting for the next writer, and resets the decoder, since a new
+    writer starts a new stream
+    :param path: FIFO path
+    :param decoder: frame_decoder (see framing.py), or any object with its feed and reset methods
+    :param buffer_size: maximum bytes read at once, a FIFO holds 64 KiB by default
+    :param on_open: function called with the path every time the FIFO is opened, e.g. to log it
+    """
+    def __init__(self, path, decoder, buffer_size=1 << 16, on_open=None):
+        self.path = path
+        self.decoder = decoder
+        self.on_open = on_open
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.fd = None
+
+        self.reads = 0
+        self.opens = 0
+
+    def open(self):
+        # blocks until there is a writer, like open(path, 'rb')
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.decoder.reset()
+        self.opens += 1
+
+        if self.on_open is not None:
+            self.on_open(self.path)
+
+    def read_batch(self):
+        """
+        :return: list of the samples decoded from one read, as returned by decoder.feed, empty if the read ended
+                 with a partial sample or the writer closed the FIFO
+        """
+        if self.fd is None:
+            self.open()
+
+        # one read syscall straight into the buffer, no new bytes object per read
+        n = os.readv(self.fd, [self.buffer])
+        self.reads += 1
+
+        if n == 0:
+            self.close()
+            return []
+
+        return self.decoder.feed(self.view[:n])
+
+    def __iter__(self):
+        """
+        yields the non empty batches forever, errors are raised to the caller, that can close the reader and iterate
+        again
+        """
+        while True:
+            batch = self.read_batch()
+            if len(batch) > 0:
+                yield batch
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
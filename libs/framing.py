@@ -0,0 +1,178 @@
+import struct
+from time import monotonic_ns
+
+
+# sensor names from the FIFO message tables in the README, a sensor ID is the index in this tuple, so new sensors
+# must only be appended
+SENSORS = (
+    "ant_speed",
+    "ant_distance",
+    "power",
+    "cadence",
+    "heartrate",
+    "gear",
+    "gnss_speed",
+    "gnss_displacement",
+    "speed",
+    "distance",
+    "time",
+)
+SENSOR_IDS = {sensor: i for i, sensor in enumerate(SENSORS)}
+
+# binary streams start with MAGIC, the protocol version and the value format, the reader detects the format from the
+# first bytes it reads, so every time the writer (re)opens the FIFO it has to send the header again
+MAGIC = b"FFSB"
+VERSION = 1
+HEADER = struct.Struct("<4sBc")
+
+# record: sensor ID, value, monotonic timestamp in nanoseconds of the producer
+RECORDS = {
+    b"f": struct.Struct("<BfQ"),
+    b"d": struct.Struct("<BdQ"),
+}
+
+FORMATS = {
+    "text": None,
+    "binary32": b"f",
+    "binary64": b"d",
+}
+
+
+class frame_encoder:
+    """
+    encodes (sensor, value) samples for a FIFO
+    :param fmt: "text" for "sensor:value" lines, "binary32" or "binary64" for fixed size records with float32 or
+                float64 values
+    :param timestamps: True to append the timestamp to text lines too ("sensor:value:timestamp"), binary records always
+                       carry it
+    binary records only carry the sensors in SENSORS, the other ones are skipped and counted in self.unknown
+    """
+    def __init__(self, fmt="text", timestamps=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown FIFO format {fmt}")
+
+        self.fmt = fmt
+        self.timestamps = timestamps
+        self.value_fmt = FORMATS[fmt]
+        self.record = RECORDS.get(self.value_fmt)
+
+        # sensor name -> samples not encoded since the sensor has no ID
+        self.unknown = {}
+
+    def header(self):
+        """
+        :return: bytes to write every time the FIFO is opened
+        """
+        if self.record is None:
+            return b""
+
+        return HEADER.pack(MAGIC, VERSION, self.value_fmt)
+
+    def encode(self, sensor, value, timestamp=None):
+        """
+        :param sensor: sensor name
+        :param value: sensor value
+        :param timestamp: monotonic timestamp in nanoseconds, now if None
+        :return: encoded sample, empty if the sensor has no ID in a binary format
+        """
+        if self.record is None:
+            if self.timestamps:
+                if timestamp is None:
+                    timestamp = monotonic_ns()
+                return f"{sensor}:{value}:{timestamp}\n".encode()
+
+            return f"{sensor}:{value}\n".encode()
+
+        if timestamp is None:
+            timestamp = monotonic_ns()
+
+        sensor_id = SENSOR_IDS.get(sensor)
+        if sensor_id is None:
+            self.unknown[sensor] = self.unknown.get(sensor, 0) + 1
+            return b""
+
+        return self.record.pack(sensor_id, float(value), timestamp)
+
+
+class frame_decoder:
+    """
+    decodes the samples read from a FIFO, the format is detected from the beginning of the stream: binary streams
+    start with the MAGIC header, anything else is read as "sensor:value" lines
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        to be called every time the FIFO is (re)opened, since a new writer sends a new header
+        """
+        self.buf = bytearray()
+        self.detected = False
+        self.record = None
+        self.invalid = 0
+
+    def _detect(self):
+        if len(self.buf) < len(MAGIC):
+            # a text stream may be shorter than the magic, but it's never a prefix of it
+            if MAGIC.startswith(bytes(self.buf)):
+                return False
+
+        elif self.buf.startswith(MAGIC):
+            if len(self.buf) < HEADER.size:
+                return False
+
+            _, version, value_fmt = HEADER.unpack_from(self.buf)
+            if version != VERSION or value_fmt not in RECORDS:
+                raise ValueError(f"unsupported FIFO protocol version {version}, format {value_fmt}")
+
+            self.record = RECORDS[value_fmt]
+            del self.buf[:HEADER.size]
+
+        self.detected = True
+        return True
+
+    def feed(self, chunk):
+        """
+        :param chunk: bytes read from the FIFO, a chunk may contain many samples and end with a partial one
+        :return: list of (sensor, value, timestamp) tuples, the value is a string and the timestamp is None for text
+                 lines without it, malformed lines and unknown sensor IDs are skipped and counted in self.invalid
+        """
+        self.buf += chunk
+
+        if not self.detected and not self._detect():
+            return []
+
+        samples = []
+
+        if self.record is None:
+            end = self.buf.rfind(b"\n") + 1
+            if end == 0:
+                return samples
+
+            for line in bytes(self.buf[:end]).split(b"\n")[:-1]:
+                try:
+                    fields = line.decode().rstrip().split(":")
+                except ValueError:
+                    self.invalid += 1
+                    continue
+
+                if len(fields) == 2:
+                    samples.append((fields[0], fields[1], None))
+                elif len(fields) == 3 and fields[2].isdigit():
+                    samples.append((fields[0], fields[1], int(fields[2])))
+                else:
+                    self.invalid += 1
+
+        else:
+            end = len(self.buf) - len(self.buf) % self.record.size
+
+            with memoryview(self.buf) as records:
+                for sensor_id, value, timestamp in self.record.iter_unpack(records[:end]):
+                    if sensor_id >= len(SENSORS):
+                        self.invalid += 1
+                        continue
+
+                    samples.append((SENSORS[sensor_id], value, timestamp))
+
+        del self.buf[:end]
+        return samples
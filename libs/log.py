@@ -1,12 +1,185 @@
-class log:
-    @staticmethod
-    def err(msg):
-        print(f"\033[1;31m[ERR] {msg}\033[0;37m")
-
-    @staticmethod
-    def warn(msg):
-        print(f"\033[1;33m[WARN] {msg}\033[0;37m")
-
-    @staticmethod
-    def info(msg):
-        print(f"[INFO] {msg}")
\ No newline at end of file
+import os, sys, json
+from multiprocessing import util
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+from time import monotonic
+
+
+LEVELS = {
+    "debug": 10,
+    "info": 20,
+    "warn": 30,
+    "err": 40
+}
+
+PREFIXES = {
+    "debug": "[DEBUG] ",
+    "info": "[INFO] ",
+    "warn": "[WARN] ",
+    "err": "[ERR] "
+}
+
+COLORS = {
+    "warn": ("\033[1;33m", "\033[0;37m"),
+    "err": ("\033[1;31m", "\033[0;37m")
+}
+
+# level, colors and queue size, missing keys keep the defaults below
+LOG_CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'log.json'))
+
+
+class _logger:
+    """
+    messages are put in a queue and printed by a background thread, so the callers never wait for stdout (journald
+    under systemd). The thread is started by the first message of every process, Process children get their own.
+
+    messages under the configured level are dropped before being queued, every=seconds prints a call site at most once
+    per interval, key separates the intervals of the same call site (e.g. one per signal), the number of messages
+    suppressed in the meantime is appended to the next one printed
+    """
+    def __init__(self, path=LOG_CONFIG):
+        self.level = LEVELS["info"]
+        self.color = True
+        self.queue_size = 4096
+
+        try:
+            with open(path) as file:
+                self.configure(**{k: v for k, v in json.load(file).items() if k != "comments"})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARN] LOG - {path}: {e}")
+
+        self.pid = None
+        self.lock = Lock()
+        # (call site, key) -> [last time printed, messages suppressed since]
+        self.limits = {}
+        self.dropped = 0
+
+    def configure(self, level=None, color=None, queue_size=None):
+        """
+        :param level: minimum level printed, "debug", "info", "warn" or "err"
+        :param color: False to print warnings and errors without ANSI codes
+        :param queue_size: messages kept while the writer thread is behind, newer ones are dropped and counted
+        """
+        if level is not None:
+            self.level = LEVELS[level]
+        if color is not None:
+            self.color = color
+        if queue_size is not None:
+            self.queue_size = queue_size
+
+    def enabled(self, level):
+        """
+        :return: True if messages of level are printed, to skip building expensive messages
+        """
+        return LEVELS[level] >= self.level
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # after a fork the queue and the thread of the parent are not usable
+            self.queue = Queue(self.queue_size)
+            self.limits = {}
+            self.dropped = 0
+            self.pid = os.getpid()
+
+            Thread(target=self._writer, daemon=True).start()
+            # run at exit both by the main process and by Process children, which skip atexit
+            util.Finalize(None, self._flush, args=(self.queue,), exitpriority=0)
+
+    def _writer(self):
+        out = sys.stdout
+        queue = self.queue
+
+        while True:
+            lines = [queue.get()]
+
+            # print everything already queued with a single write
+            try:
+                while len(lines) < 256:
+                    lines.append(queue.get_nowait())
+            except Empty:
+                pass
+
+            done = len(lines)
+
+            with self.lock:
+                dropped = self.dropped
+                self.dropped = 0
+            if dropped > 0:
+                lines.append(self._format("warn", f"LOG: {dropped} messages dropped, queue full"))
+
+            try:
+                out.write("".join(lines))
+                out.flush()
+            except Exception:
+                pass
+
+            for _ in range(done):
+                queue.task_done()
+
+    def _flush(self, queue, timeout=1.0):
+        # the writer thread is a daemon, give it a chance to print the last messages before exiting
+        if self.pid != os.getpid():
+            return
+
+        deadline = monotonic() + timeout
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks > 0 and monotonic() < deadline:
+                queue.all_tasks_done.wait(deadline - monotonic())
+
+    def _format(self, level, msg):
+        if self.color and level in COLORS:
+            start, end = COLORS[level]
+            return f"{start}{PREFIXES[level]}{msg}{end}\n"
+
+        return f"{PREFIXES[level]}{msg}\n"
+
+    def _log(self, level, msg, every, key):
+        if LEVELS[level] < self.level:
+            return
+
+        if self.pid != os.getpid():
+            self._start()
+
+        if every is not None:
+            caller = sys._getframe(2)
+            site = (caller.f_code, caller.f_lineno, key)
+            now = monotonic()
+
+            limit = self.limits.get(site)
+            if limit is None:
+                self.limits[site] = [now, 0]
+            elif now - limit[0] < every:
+                limit[1] += 1
+                return
+            else:
+                if limit[1] > 0:
+                    msg = f"{msg} ({limit[1]} suppressed)"
+                limit[0] = now
+                limit[1] = 0
+
+        try:
+            self.queue.put_nowait(self._format(level, msg))
+        except Full:
+            # many threads may find the queue full at the same time
+            with self.lock:
+                self.dropped += 1
+
+    def err(self, msg, every=None, key=None):
+        self._log("err", msg, every, key)
+
+    def warn(self, msg, every=None, key=None):
+        self._log("warn", msg, every, key)
+
+    def info(self, msg, every=None, key=None):
+        self._log("info", msg, every, key)
+
+    def debug(self, msg, every=None, key=None):
+        self._log("debug", msg, every, key)
+
+
+log = _logger()
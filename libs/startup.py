@@ -0,0 +1,87 @@
+import os, json
+from time import time, clock_gettime, CLOCK_BOOTTIME
+
+
+# one JSON line per module start, read it to follow the boot latency over time
+STARTUP_LOG = os.path.expanduser("~/bob/startup.jsonl")
+
+
+def _process_start():
+    """
+    :return: CLOCK_BOOTTIME seconds of the process start, now if /proc is not there
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # the command name may contain spaces, the fields after it are fixed, starttime is the 22nd
+            fields = file.read().rsplit(")", 1)[1].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return clock_gettime(CLOCK_BOOTTIME)
+
+
+class _startup:
+    """
+    startup milestones of a module, in seconds since its process was started: every milestone is timed the first time
+    it is reached and, at the last one, all of them are appended to STARTUP_LOG together with the seconds from the boot
+    to the process start. Processes forked by the module keep its start time, so their milestones add up
+    """
+    def __init__(self):
+        self.origin = _process_start()
+        self.name = "ffs"
+        self.last = None
+        self.output = STARTUP_LOG
+        self.milestones = {}
+
+    def configure(self, name=None, last=None, output=None):
+        """
+        :param name: module name, written in the report
+        :param last: milestone that writes the report, e.g. "first_frame"
+        :param output: JSON lines file of the reports, "" to only log the milestones
+        """
+        if name is not None:
+            self.name = name
+        if last is not None:
+            self.last = last
+        if output is not None:
+            self.output = output
+
+    def mark(self, milestone):
+        """
+        :param milestone: milestone name, only its first mark counts
+        :return: seconds since the process start
+        """
+        if milestone in self.milestones:
+            return self.milestones[milestone]
+
+        elapsed = round(clock_gettime(CLOCK_BOOTTIME) - self.origin, 3)
+        self.milestones[milestone] = elapsed
+
+        if milestone == self.last:
+            self.report()
+
+        return elapsed
+
+    def report(self):
+        """
+        appends the milestones reached so far to the output file
+        """
+        if not self.output:
+            return
+
+        entry = {
+            "module": self.name,
+            "pid": os.getpid(),
+            "time": round(time(), 3),
+            "process_start_since_boot": round(self.origin, 3),
+            "milestones": self.milestones
+        }
+
+        try:
+            os.makedirs(os.path.dirname(self.output), exist_ok=True)
+            with open(self.output, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            print(f"[WARN] STARTUP - {self.output}: {e}")
+
+
+startup = _startup()
@@ -0,0 +1,157 @@
+import os, mmap, struct
+from time import monotonic_ns
+
+# libs is imported both as a package and from the modules as a folder in sys.path
+try:
+    from .framing import SENSORS, SENSOR_IDS
+except ImportError:
+    from framing import SENSORS, SENSOR_IDS
+
+
+MAGIC = b"FFST"
+VERSION = 1
+HEADER = struct.Struct("<4sBxxxI")
+
+# slot: sequence number, value, monotonic timestamp in nanoseconds of the writer
+SLOT = struct.Struct("<QdQ")
+SEQ = struct.Struct("<Q")
+DATA = struct.Struct("<dQ")
+
+SIZE = HEADER.size + SLOT.size * len(SENSORS)
+
+# reads of a slot retried while it is being written, a write takes a few microseconds, a slot odd for longer belongs to
+# a writer that stopped between its two sequence number stores
+MAX_RETRIES = 10000
+
+
+class telemetry_store:
+    """
+    latest value table shared between modules through a memory mapped file, one slot per sensor in SENSORS
+
+    every slot is a seqlock: the writer makes the sequence number odd, writes value and timestamp and makes it even
+    again, readers retry if the number is odd or changed while they were reading, so writers never wait for readers
+    and old samples are overwritten in place. Each sensor must have a single writer. A writer that dies in the middle of
+    a write leaves the slot odd, the next writer makes it even again when it opens the table
+    :param path: table file path
+    :param writer: True to create the table and write it, False to open an existing one read-only
+    """
+    def __init__(self, path, writer=False):
+        self.path = path
+        self.writer = writer
+
+        if writer:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != SIZE:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, SIZE)
+                self.mm = mmap.mmap(fd, SIZE)
+            finally:
+                os.close(fd)
+
+            HEADER.pack_into(self.mm, 0, MAGIC, VERSION, len(SENSORS))
+
+            # slots left odd by a writer that died in the middle of a write, value and timestamp are a single copy,
+            # they are either the old or the new ones
+            for i in range(len(SENSORS)):
+                offset = HEADER.size + i * SLOT.size
+                seq = SEQ.unpack_from(self.mm, offset)[0]
+                if seq & 1:
+                    SEQ.pack_into(self.mm, offset, seq + 1)
+
+        else:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                self.mm = mmap.mmap(fd, SIZE, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+
+            magic, version, n_slots = HEADER.unpack_from(self.mm, 0)
+            if magic != MAGIC or version != VERSION or n_slots != len(SENSORS):
+                self.mm.close()
+                raise ValueError(f"{path} is not a telemetry store v{VERSION} with {len(SENSORS)} slots")
+
+        self.last_seqs = [0] * len(SENSORS)
+        # sensor name -> samples not written since the sensor has no slot
+        self.unknown = {}
+
+    def write(self, sensor, value, timestamp=None):
+        """
+        :param sensor: sensor name
+        :param value: sensor value
+        :param timestamp: monotonic timestamp in nanoseconds, now if None
+        :return: False if the sensor has no slot, it is counted in self.unknown
+        """
+        sensor_id = SENSOR_IDS.get(sensor)
+        if sensor_id is None:
+            self.unknown[sensor] = self.unknown.get(sensor, 0) + 1
+            return False
+
+        if timestamp is None:
+            timestamp = monotonic_ns()
+
+        offset = HEADER.size + sensor_id * SLOT.size
+        seq = SEQ.unpack_from(self.mm, offset)[0]
+
+        SEQ.pack_into(self.mm, offset, seq + 1)
+        DATA.pack_into(self.mm, offset + SEQ.size, float(value), timestamp)
+        SEQ.pack_into(self.mm, offset, seq + 2)
+        return True
+
+    def send(self, data):
+        """
+        same interface as the Pipe writer, so the store can take the place of the video Pipe
+        :param data: (sensor, value) tuple, or (sensor, value, reception time) when tracing
+        """
+        self.write(data[0], data[1], data[2] if len(data) > 2 else None)
+
+    def _read_slot(self, i):
+        """
+        :return: (seq, value, timestamp), None if the slot was being written for all of MAX_RETRIES reads
+        """
+        offset = HEADER.size + i * SLOT.size
+
+        for _ in range(MAX_RETRIES):
+            seq, value, timestamp = SLOT.unpack_from(self.mm, offset)
+            if seq & 1 == 0 and SEQ.unpack_from(self.mm, offset)[0] == seq:
+                return seq, value, timestamp
+
+        return None
+
+    def read(self, sensor):
+        """
+        :param sensor: sensor name
+        :return: (value, timestamp, seq) of the latest sample, seq is 0 if the sensor was never written
+        """
+        slot = self._read_slot(SENSOR_IDS[sensor])
+        if slot is None:
+            raise RuntimeError(f"{sensor} slot still being written after {MAX_RETRIES} reads, "
+                               f"did its writer stop in the middle of a write?")
+
+        seq, value, timestamp = slot
+        return value, timestamp, seq
+
+    def read_changed(self):
+        """
+        :return: list of (sensor, value, timestamp) of the sensors written since the previous call, a slot that is
+                 being written for too long is left out, and read again by the next call
+        """
+        changed = []
+
+        for i, sensor in enumerate(SENSORS):
+            # cheap check before the consistent read
+            if SEQ.unpack_from(self.mm, HEADER.size + i * SLOT.size)[0] == self.last_seqs[i]:
+                continue
+
+            slot = self._read_slot(i)
+            if slot is None:
+                continue
+
+            seq, value, timestamp = slot
+            self.last_seqs[i] = seq
+            changed.append((sensor, value, timestamp))
+
+        return changed
+
+    def close(self):
+        self.mm.close()
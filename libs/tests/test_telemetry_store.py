@@ -0,0 +1,43 @@
+import os, sys
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from telemetry_store import telemetry_store, HEADER, SLOT, SEQ
+from framing import SENSOR_IDS
+
+
+def test_writer_crash_then_reopen(tmp_path):
+    path = str(tmp_path / "telemetry")
+
+    writer = telemetry_store(path, writer=True)
+    writer.write("speed", 30.0, 1)
+
+    # the writer died between its two sequence number stores
+    offset = HEADER.size + SENSOR_IDS["speed"] * SLOT.size
+    SEQ.pack_into(writer.mm, offset, 3)
+    writer.close()
+
+    writer = telemetry_store(path, writer=True)
+    writer.write("speed", 42.0, 2)
+
+    reader = telemetry_store(path)
+    value, timestamp, seq = reader.read("speed")
+    assert (value, timestamp) == (42.0, 2)
+    assert seq % 2 == 0
+    assert reader.read_changed()[0] == ("speed", 42.0, 2)
+
+
+def test_reader_gives_up_on_odd_slot(tmp_path):
+    path = str(tmp_path / "telemetry")
+
+    writer = telemetry_store(path, writer=True)
+    writer.write("speed", 30.0, 1)
+    writer.write("power", 200.0, 1)
+    reader = telemetry_store(path)
+
+    # writer stopped in the middle of a write and never reopened
+    SEQ.pack_into(writer.mm, HEADER.size + SENSOR_IDS["speed"] * SLOT.size, 3)
+
+    assert reader.read_changed() == [("power", 200.0, 1)]
+    with pytest.raises(RuntimeError):
+        reader.read("speed")
@@ -0,0 +1,181 @@
+import os, json, socket
+from math import log2
+from threading import Thread, Lock
+from time import sleep, time_ns, monotonic_ns
+
+
+# points where a sample is timestamped, in the order it goes through them
+STAGES = ("rx", "pipe", "fifo", "parse", "render", "display")
+
+# histogram buckets are quarter octaves of microseconds, ~19% wide, up to ~2^32 us
+BUCKETS_PER_OCTAVE = 4
+N_BUCKETS = 32 * BUCKETS_PER_OCTAVE
+
+# enabled flag, dump interval and destination, missing keys keep the defaults below
+TRACE_CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'trace.json'))
+
+
+def _bucket(us):
+    if us < 1:
+        return 0
+    return min(N_BUCKETS - 1, int(log2(us) * BUCKETS_PER_OCTAVE) + 1)
+
+
+def _bucket_upper(i):
+    return 2 ** (i / BUCKETS_PER_OCTAVE)
+
+
+class _tracer:
+    """
+    per sensor latency histograms of the samples going from the CAN Bus to the screen: every stage records the time
+    elapsed since the frame carrying the sample was received (CLOCK_MONOTONIC nanoseconds, the same in every process),
+    the origin timestamp travels with the sample through Pipes, FIFOs and the telemetry store.
+
+    when disabled the callers only check trace.enabled, when enabled every process dumps its histograms every interval
+    seconds, as JSON, to a file or to a Unix datagram socket
+    """
+    def __init__(self, path=TRACE_CONFIG):
+        self.enabled = False
+        self.interval = 10
+        self.output = "~/bob/trace"
+        self.socket = None
+        self.name = "ffs"
+
+        try:
+            with open(path) as file:
+                self.configure(**{k: v for k, v in json.load(file).items() if k != "comments"})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARN] TRACE - {path}: {e}")
+
+        self.pid = None
+        self.lock = Lock()
+        self.histograms = {}
+
+    def configure(self, enabled=None, interval=None, output=None, socket=None, name=None):
+        """
+        :param enabled: True to record the stages
+        :param interval: seconds between two dumps
+        :param output: folder of the dumps, one <name>_<pid>.json file per process, "" to only keep them in memory
+        :param socket: Unix datagram socket path the dumps are sent to, instead of the files
+        :param name: process name in the dumps, e.g. "can" or "video"
+        """
+        if enabled is not None:
+            self.enabled = enabled
+        if interval is not None:
+            self.interval = interval
+        if output is not None:
+            self.output = output
+        if socket is not None:
+            self.socket = socket
+        if name is not None:
+            self.name = name
+
+    @staticmethod
+    def now():
+        return monotonic_ns()
+
+    @staticmethod
+    def from_wall(timestamp):
+        """
+        :param timestamp: wall clock timestamp in seconds, e.g. can.Message.timestamp from socketcan
+        :return: the same instant in monotonic nanoseconds
+        """
+        return monotonic_ns() - (time_ns() - int(timestamp * 1e9))
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # after a fork the histograms belong to the parent
+            self.histograms = {}
+            self.pid = os.getpid()
+
+            if self.output or self.socket:
+                Thread(target=self._dumper, daemon=True).start()
+
+    def record(self, stage, sensor, origin, now=None):
+        """
+        :param stage: one of STAGES
+        :param sensor: sensor name
+        :param origin: monotonic nanoseconds of the frame reception, None if unknown
+        :param now: monotonic nanoseconds of the stage, now if None
+        """
+        if origin is None:
+            return
+
+        if self.pid != os.getpid():
+            self._start()
+
+        if now is None:
+            now = monotonic_ns()
+
+        key = (sensor, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * N_BUCKETS
+
+        histogram[_bucket((now - origin) / 1e3)] += 1
+
+    def snapshot(self):
+        """
+        :return: dictionary {sensor: {stage: {"count", "p50", "p95", "p99", "max"}}}, latencies in microseconds as
+                 upper bounds of their histogram buckets
+        """
+        res = {}
+        for (sensor, stage), histogram in list(self.histograms.items()):
+            histogram = list(histogram)
+            count = sum(histogram)
+            if count == 0:
+                continue
+
+            stats = {"count": count}
+            targets = [("p50", 0.5), ("p95", 0.95), ("p99", 0.99)]
+            cumulative = 0
+            for i, n in enumerate(histogram):
+                cumulative += n
+                while len(targets) > 0 and cumulative >= targets[0][1] * count:
+                    stats[targets.pop(0)[0]] = round(_bucket_upper(i), 1)
+                if n > 0:
+                    last = i
+
+            stats["max"] = round(_bucket_upper(last), 1)
+
+            res.setdefault(sensor, {})[stage] = stats
+
+        # stages in pipeline order
+        return {sensor: {stage: stages[stage] for stage in STAGES if stage in stages} for sensor, stages in res.items()}
+
+    def dump(self):
+        """
+        writes the current snapshot to the output folder or socket
+        """
+        data = json.dumps({"name": self.name, "pid": os.getpid(), "latency_us": self.snapshot()}).encode()
+
+        if self.socket is not None:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(data, self.socket)
+            return
+
+        folder = os.path.expanduser(self.output)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{self.name}_{os.getpid()}.json")
+
+        # readers never see a partial file
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _dumper(self):
+        while True:
+            sleep(self.interval)
+            try:
+                self.dump()
+            except OSError:
+                # no one listening on the socket, or the folder is not writable, the next dump may succeed
+                pass
+
+
+trace = _tracer()
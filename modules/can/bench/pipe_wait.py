@@ -0,0 +1,81 @@
+"""
+Idle CPU and wake-up latency of the CAN module Pipe consumers, busy-wait poll() loop against blocking recv().
+
+Usage: python3 bench/pipe_wait.py [--idle SECONDS] [--samples N]
+"""
+import os, argparse
+from time import sleep, perf_counter
+from multiprocessing import Process, Pipe
+
+
+def poll_consumer(reader, fd_out):
+    # same shape as the old vid_writer/can_manager loops
+    while True:
+        if reader.poll():
+            data = reader.recv()
+            if data is None:
+                break
+            os.write(fd_out, f"{data}\n".encode())
+
+
+def recv_consumer(reader, fd_out):
+    while True:
+        data = reader.recv()
+        if data is None:
+            break
+        os.write(fd_out, f"{data}\n".encode())
+
+
+def cpu_time(pid):
+    """
+    :return: user + system CPU time of the given process in seconds
+    """
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def run(consumer, idle, samples):
+    reader, writer = Pipe(duplex=False)
+    fd_in, fd_out = os.pipe()
+
+    proc = Process(target=consumer, args=(reader, fd_out,))
+    proc.start()
+    sleep(0.5)
+
+    cpu_start = cpu_time(proc.pid)
+    sleep(idle)
+    idle_cpu = (cpu_time(proc.pid) - cpu_start) / idle
+
+    latencies = []
+    for _ in range(samples):
+        start = perf_counter()
+        writer.send(start)
+        os.read(fd_in, 64)
+        latencies.append(perf_counter() - start)
+        sleep(0.01)
+
+    writer.send(None)
+    proc.join()
+    os.close(fd_in)
+    os.close(fd_out)
+
+    latencies.sort()
+    return idle_cpu, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--idle", type=float, default=3.0, help="idle window in seconds")
+    parser.add_argument("--samples", type=int, default=500, help="number of latency samples")
+    args = parser.parse_args()
+
+    print(f"{'loop':<8}{'idle CPU':>10}{'p50 latency':>14}{'p99 latency':>14}")
+    for name, consumer in (("poll", poll_consumer), ("recv", recv_consumer)):
+        idle_cpu, p50, p99 = run(consumer, args.idle, args.samples)
+        print(f"{name:<8}{idle_cpu * 100:>9.1f}%{p50 * 1e6:>12.1f}us{p99 * 1e6:>12.1f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +0,0 @@
-#!/bin/bash
-
-stdbuf -i0 -o0 -e0 candump -tz can0 >> $(date +"%Y-%m-%dT%H:%M:%S%z")
\ No newline at end of file
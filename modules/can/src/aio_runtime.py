@@ -0,0 +1,255 @@
+import os, sys, errno
+import asyncio
+from time import monotonic
+import can
+
+from .can_msg_manager import can_msg_manager, tee_writer
+from .tx_scheduler import tx_from_conf
+from .recorder import recorder_from_conf
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+from tracing import trace
+from framing import frame_encoder, frame_decoder, MAGIC
+from telemetry_store import telemetry_store
+
+
+class fifo_sink:
+    """
+    non-blocking writer of the video FIFO, it replaces the video Pipe as the can_msg_manager writer, so it must only be
+    used from the event loop
+    :param path: video FIFO path
+    :param loop: asyncio event loop
+    :param encoder: frame_encoder of the video FIFO format
+    :param max_pending: bytes kept while the video module is not keeping up, newer data is dropped beyond that
+    :param reopen_interval: seconds between two attempts to open the FIFO while there is no reader
+    """
+    def __init__(self, path, loop, encoder, max_pending=65536, reopen_interval=1.0):
+        self.path = path
+        self.loop = loop
+        self.encoder = encoder
+        self.max_pending = max_pending
+        self.reopen_interval = reopen_interval
+
+        self.fd = None
+        self.last_open = 0
+        self.pending = bytearray()
+        self.dropped = 0
+
+    def _open(self):
+        now = monotonic()
+        if now - self.last_open < self.reopen_interval:
+            return False
+        self.last_open = now
+
+        try:
+            # O_NONBLOCK makes open fail with ENXIO instead of waiting for the video module
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                log.err(f"FIFO SINK: {e}")
+            return False
+
+        log.info(f"FIFO SINK - {self.path} opened")
+        return True
+
+    def _close(self):
+        if len(self.pending) > 0:
+            self.loop.remove_writer(self.fd)
+            self.pending.clear()
+
+        os.close(self.fd)
+        self.fd = None
+
+    def _flush(self):
+        try:
+            n = os.write(self.fd, self.pending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            log.err(f"FIFO SINK: {e}")
+            self._close()
+            return
+
+        del self.pending[:n]
+        if len(self.pending) == 0:
+            self.loop.remove_writer(self.fd)
+
+    def _drop(self):
+        self.dropped += 1
+        log.warn(f"FIFO SINK: {self.dropped} samples dropped, video FIFO closed or full", every=60)
+
+    def send(self, data):
+        """
+        same interface as the Pipe writer
+        :param data: (sensor, value) tuple, or (sensor, value, reception time) when tracing
+        """
+        origin = data[2] if len(data) > 2 else None
+        payload = self.encoder.encode(data[0], data[1], origin)
+        if len(payload) == 0:
+            log.warn(f"FIFO SINK: {data[0]} is not in SENSORS, {self.encoder.unknown[data[0]]} samples not sent",
+                     every=60, key=data[0])
+            return
+
+        if self.fd is None:
+            if not self._open():
+                self._drop()
+                return
+
+            # a new reader detects the format from the beginning of the stream
+            payload = self.encoder.header() + payload
+
+        if len(self.pending) > 0:
+            # the FIFO is full, the flush callback is already waiting for it to be writable
+            if len(self.pending) + len(payload) > self.max_pending:
+                self._drop()
+            else:
+                self.pending += payload
+            return
+
+        try:
+            n = os.write(self.fd, payload)
+        except BlockingIOError:
+            n = 0
+        except OSError as e:
+            log.err(f"FIFO SINK: {e}")
+            self._drop()
+            self._close()
+            return
+
+        if n < len(payload):
+            self.pending += payload[n:]
+            self.loop.add_writer(self.fd, self._flush)
+        elif origin is not None:
+            trace.record("fifo", data[0], origin)
+
+
+class fifo_source:
+    """
+    non-blocking reader of the ant FIFO, calls back for every decoded sample
+    :param path: ant FIFO path
+    :param loop: asyncio event loop
+    :param callback: function called with each (sensor, value) read
+    """
+    def __init__(self, path, loop, callback):
+        self.path = path
+        self.loop = loop
+        self.callback = callback
+        self.decoder = frame_decoder()
+
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # keeping a writer open on our own FIFO means no EOF when the ant module goes away, otherwise the FIFO would
+        # always be readable and the loop would spin
+        self.keepalive_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+
+        loop.add_reader(self.fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            chunk = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+
+        # the keepalive writer hides the ant module restarts, so a new stream is detected by its header
+        if chunk.startswith(MAGIC):
+            self.decoder.reset()
+
+        try:
+            samples = self.decoder.feed(chunk)
+        except Exception as e:
+            log.err(f"ANT READER (decode): {e}")
+            self.decoder.reset()
+            return
+
+        for sensor, value, _ in samples:
+            self.callback(sensor, value)
+
+    def close(self):
+        self.loop.remove_reader(self.fd)
+        os.close(self.fd)
+        os.close(self.keepalive_fd)
+
+
+async def ant_sender(tx, wake):
+    """
+    sends on the CAN Bus the ANT data read from the ant FIFO, the sends never block so they run in the event loop
+    :param tx: tx_scheduler updated with the ANT data
+    :param wake: asyncio event set on every update
+    """
+    while True:
+        wake.clear()
+        delay = tx.poll()
+
+        # woken by the next update or when the next message is due, None waits for an update
+        try:
+            await asyncio.wait_for(wake.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def can_module(bus, dbc, sensors_to_dbc, dbc_to_sensors, fifo_can, fifo_vid, can_writers, fifo_format="text",
+                     video_output=("fifo",), store_path=None, recorder_conf={}, tx_conf={}, dispatch=None):
+    """
+    single process CAN module runtime: the CAN socket, the ant FIFO and the video FIFO are all served by one event loop
+    :param bus: python-can bus
+    :param dbc: cantools database
+    :param sensors_to_dbc: JSON-based dictionary that encodes sensors into CAN messages
+    :param dbc_to_sensors: JSON-based dictionary that decodes sensors types for the video
+    :param fifo_can: ant FIFO path
+    :param fifo_vid: video FIFO path
+    :param can_writers: sensors read from the ant FIFO that have to be sent on the CAN Bus
+    :param fifo_format: video FIFO format, "text", "binary32" or "binary64" (see libs/framing.py)
+    :param video_output: where CAN-received data are sent to the video module, "fifo" and/or "store"
+    :param store_path: telemetry store path, used if video_output contains "store"
+    :param recorder_conf: "recorder" dictionary of can.json
+    :param tx_conf: "tx" dictionary of can.json
+    :param dispatch: CAN RX dispatch table, e.g. from the DBC cache, None to build it from dbc
+    """
+    loop = asyncio.get_running_loop()
+    tx = tx_from_conf(bus, dbc, sensors_to_dbc, can_writers, tx_conf)
+    tx_wake = asyncio.Event()
+
+    def on_ant_sample(sensor, value):
+        log.info(f"{sensor}: {value}", every=1, key=sensor)
+
+        if sensor in can_writers:
+            try:
+                tx.update(sensor, value)
+            except Exception as e:
+                log.err(f"ANT SENDER: {e}", every=1, key=sensor)
+                return
+            tx_wake.set()
+
+    writers = []
+    if "fifo" in video_output:
+        writers.append(fifo_sink(fifo_vid, loop, frame_encoder(fifo_format, timestamps=trace.enabled)))
+    if "store" in video_output:
+        writers.append(telemetry_store(store_path, writer=True))
+
+    source = fifo_source(fifo_can, loop, on_ant_sample)
+
+    msg_handler = can_msg_manager(tee_writer(writers), dbc_to_sensors, dbc, dispatch)
+    listeners = [msg_handler]
+
+    # buffered writes, the loop only waits for the disk once per buffer
+    recorder = recorder_from_conf(recorder_conf)
+    if recorder is not None:
+        listeners.append(recorder)
+
+    # with a loop the Notifier serves the CAN socket with add_reader and calls the handler inside the loop
+    notifier = can.Notifier(bus, listeners, loop=loop)
+
+    log.info(f"CAN MODULE - asyncio runtime started")
+
+    try:
+        await ant_sender(tx, tx_wake)
+    finally:
+        notifier.stop()
+        source.close()
+        if recorder is not None:
+            recorder.stop()
+
+        stats = tx.stats()
+        log.info(f"CAN TX: {stats['sent']} frames sent, {stats['coalesced']} updates coalesced, "
+                 f"{stats['failed']} sends failed")
@@ -1,39 +1,118 @@
 import sys, os
-import can, cantools
+import can
+
+from .dbc_routing import build_dispatch_table, extract_signal
 
 # append into path the libs folder, so that Python will find them
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
 from log import log
+from tracing import trace
+from startup import startup
+
+
+class tee_writer:
+    """
+    forwards every sample to all the given writers, used when CAN data goes to more than one destination
+    :param writers: list of objects with the Pipe writer send method
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def send(self, data):
+        for writer in self.writers:
+            writer.send(data)
+
 
 class can_msg_manager(can.Listener):
     
-    def __init__(self, writer, dbc_to_sensors, dbc):
+    def __init__(self, writer, dbc_to_sensors, dbc, dispatch=None, stats_interval=60):
         """
         CAN message manager object
         :param writer: writer Pipe that sends CAN-read data to the process managing the video FIFO
         :param dbc_to_sensor: JSON-based dictionary that decodes sensors types for the video
         :param dbc: dbc specification file
+        :param dispatch: dispatch table built by build_dispatch_table, e.g. from the DBC cache, None to build it
+        :param stats_interval: seconds between two logs of the forwarded and suppressed values of the filtered signals
         """
         self.writer = writer
         self.dbc_to_sensors = dbc_to_sensors
         self.dbc = dbc
+
+        # frames without routed signals are not in the table, so they are dropped before any decoding
+        self.dispatch = build_dispatch_table(dbc, dbc_to_sensors) if dispatch is None else dispatch
+        self.received = False
+
+        self.stats_interval = stats_interval
+        self.last_stats = None
         return
 
+    def stats(self):
+        """
+        :return: dictionary {sensor: {"forwarded": n, "suppressed": n}} of the signals with a deadband, minimum
+                 interval or heartbeat
+        """
+        return {
+            sensor: {"forwarded": rx_filter.forwarded, "suppressed": rx_filter.suppressed}
+            for _, _, signals in self.dispatch.values()
+            for _, sensor, _, rx_filter in signals
+            if rx_filter is not None
+        }
+
 
     def on_message_received(self, msg: can.Message) -> None:
+        if not self.received:
+            self.received = True
+            startup.mark("first_can_rx")
+            log.info(f"CAN RX - first frame, startup milestones: {startup.milestones}")
+            self.last_stats = msg.timestamp
+
+        if msg.timestamp - self.last_stats >= self.stats_interval:
+            self.last_stats = msg.timestamp
+            stats = self.stats()
+            # nothing to tell without filters
+            if len(stats) > 0:
+                log.info("CAN RX: " + ", ".join(f"{sensor} {s['forwarded']} forwarded {s['suppressed']} suppressed"
+                                                for sensor, s in stats.items()))
+
+        entry = self.dispatch.get(msg.arbitration_id)
+        if entry is None:
+            return
+
+        msg_name, msg_length, signals = entry
+
+        if len(msg.data) < msg_length:
+            log.err(f"CAN RX - DBC CONV ERROR: {msg_name} is {len(msg.data)} bytes long, {msg_length} expected - "
+                    f"{msg.arbitration_id}", every=1, key=msg.arbitration_id)
+            return
+
         try:
-            decoded_msg = self.dbc.decode_message(msg.arbitration_id, msg.data)
-            try:
-                msg_name = self.dbc.get_message_by_frame_id(msg.arbitration_id).name
+            raw = int.from_bytes(msg.data, "little")
+            decoded_msg = None
 
-                for signal in decoded_msg:
-                    if self.dbc_to_sensors[msg_name][signal]["sensor"] != None:
-                        self.writer.send((self.dbc_to_sensors[msg_name][signal]["sensor"], decoded_msg[signal]))
+            # reception time of the frame, it travels with the samples when tracing
+            origin = trace.from_wall(msg.timestamp) if trace.enabled else None
 
-                        log.info(f"CAN RX: {msg_name}, {signal}: {decoded_msg[signal]}")
-            except Exception as can_id_err:
-                log.err(f"CAN RX - CAN ID ERROR: {can_id_err}")
+            for signal, sensor, compiled, rx_filter in signals:
+                if compiled is not None:
+                    value = extract_signal(raw, compiled)
+                else:
+                    # signals that can't be precompiled are left to cantools
+                    if decoded_msg is None:
+                        decoded_msg = self.dbc.decode_message(msg.arbitration_id, msg.data)
+                    value = decoded_msg[signal]
+
+                # unchanged values are not forwarded, see rx_filter
+                if rx_filter is not None and not rx_filter.accept(value, msg.timestamp):
+                    continue
+
+                if origin is None:
+                    self.writer.send((sensor, value))
+                else:
+                    trace.record("rx", sensor, origin)
+                    self.writer.send((sensor, value, origin))
+
+                log.info(f"CAN RX: {msg_name}, {signal}: {value}", every=1, key=signal)
         except Exception as can_dbc_err:
-            log.err(f"CAN RX - DBC CONV ERROR: {can_dbc_err} - {msg.arbitration_id}")
+            log.err(f"CAN RX - DBC CONV ERROR: {can_dbc_err} - {msg.arbitration_id}", every=1, key=msg.arbitration_id)
 
-        return
\ No newline at end of file
+        return
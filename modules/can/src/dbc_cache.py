@@ -0,0 +1,71 @@
+import os, sys, json, pickle, hashlib
+import cantools
+
+from .dbc_routing import build_dispatch_table
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+CACHE_DIR = os.path.expanduser("~/bob/cache")
+
+# bump it when the cached tables change layout
+CACHE_VERSION = 2
+
+
+def _cache_key(dbc_path, dbc_to_sensors):
+    digest = hashlib.sha256()
+    with open(dbc_path, "rb") as file:
+        digest.update(file.read())
+    digest.update(json.dumps(dbc_to_sensors, sort_keys=True).encode())
+    # pickles of a cantools database are only valid for the same cantools version
+    digest.update(f"{cantools.__version__}:{CACHE_VERSION}".encode())
+
+    return digest.hexdigest()[:16]
+
+
+def load_database(dbc_path, dbc_to_sensors, cache_dir=CACHE_DIR):
+    """
+    loads the DBC and builds the CAN RX dispatch table, both are pickled in cache_dir so the next starts skip the DBC
+    parsing, the cache file name has the hash of the DBC, of dbc_to_sensors and of the cantools version, so any change
+    to them parses the DBC again
+    :param dbc_path: DBC file
+    :param dbc_to_sensors: JSON-based dictionary that decodes sensors types for the video
+    :param cache_dir: cache folder, None to always parse the DBC
+    :return: (cantools database, dispatch table as built by build_dispatch_table)
+    """
+    if cache_dir is None:
+        dbc = cantools.database.load_file(dbc_path)
+        return dbc, build_dispatch_table(dbc, dbc_to_sensors)
+
+    prefix = os.path.splitext(os.path.basename(dbc_path))[0]
+    path = os.path.join(cache_dir, f"{prefix}_{_cache_key(dbc_path, dbc_to_sensors)}.pickle")
+
+    try:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warn(f"DBC CACHE - {path}: {e}, parsing the DBC")
+
+    dbc = cantools.database.load_file(dbc_path)
+    database = (dbc, build_dispatch_table(dbc, dbc_to_sensors))
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # older caches of the same DBC are stale
+        for name in os.listdir(cache_dir):
+            if name.startswith(f"{prefix}_") and name.endswith(".pickle"):
+                os.remove(os.path.join(cache_dir, name))
+
+        # written aside and renamed, a power loss never leaves half a cache
+        with open(path + ".tmp", "wb") as file:
+            pickle.dump(database, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log.warn(f"DBC CACHE - {path}: {e}")
+
+    return database
@@ -0,0 +1,167 @@
+def compile_signal(signal):
+    """
+    precompiles a DBC signal into the parameters needed to extract it from a frame payload read as a little endian
+    integer
+    :param signal: cantools signal object
+    :return: (start, mask, sign_bit, scale, offset, is_int) tuple, None if the signal can't be extracted with a shift and
+             a mask (big endian, float or enumerated signals), in that case cantools has to decode it
+    """
+    if signal.byte_order != "little_endian" or signal.is_float or signal.choices:
+        return None
+
+    mask = (1 << signal.length) - 1
+    sign_bit = 1 << (signal.length - 1) if signal.is_signed else 0
+
+    # cantools returns integers for unscaled signals, keep the same representation for the FIFO messages
+    is_int = signal.scale == 1 and signal.offset == 0
+
+    return (signal.start, mask, sign_bit, signal.scale, signal.offset, is_int)
+
+
+def extract_signal(raw, compiled):
+    """
+    extracts a signal value from a frame payload
+    :param raw: frame payload as a little endian integer
+    :param compiled: compiled signal, as returned by compile_signal
+    :return: physical signal value
+    """
+    start, mask, sign_bit, scale, offset, is_int = compiled
+
+    val = (raw >> start) & mask
+    if val & sign_bit:
+        val -= mask + 1
+
+    if is_int:
+        return val
+
+    return val * scale + offset
+
+
+def encode_signal(value, compiled):
+    """
+    inverse of extract_signal, rounds like cantools
+    :param value: physical signal value
+    :param compiled: compiled signal, as returned by compile_signal
+    :return: signal bits already shifted to the signal position, to be or-ed into the payload
+    :raise ValueError: if the value doesn't fit in the signal bits
+    """
+    start, mask, sign_bit, scale, offset, is_int = compiled
+
+    if is_int:
+        val = round(value)
+    else:
+        val = round((value - offset) / scale)
+
+    if (sign_bit and not -sign_bit <= val < sign_bit) or (not sign_bit and not 0 <= val <= mask):
+        raise ValueError(f"{value} doesn't fit in the signal bits")
+
+    return (val & mask) << start
+
+
+class rx_filter:
+    """
+    change-only forwarding of a received signal: a value is forwarded if it moved more than the deadband from the last
+    forwarded one and at least min_interval after it, or if heartbeat elapsed since it, even unchanged. CAN frames are
+    periodic, so a change held back by min_interval is forwarded by the next frame after it
+    :param deadband: absolute deadband, in signal units, 0 forwards any change
+    :param deadband_rel: deadband relative to the last forwarded value, e.g. 0.01 for 1%, the larger one is used
+    :param min_interval: minimum seconds between two forwarded values
+    :param heartbeat: maximum seconds without forwarding, None for no heartbeat
+    """
+    __slots__ = ("deadband", "deadband_rel", "min_interval", "heartbeat", "last_value", "last_time", "forwarded",
+                 "suppressed")
+
+    def __init__(self, deadband=0, deadband_rel=0, min_interval=0, heartbeat=None):
+        self.deadband = deadband
+        self.deadband_rel = deadband_rel
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+
+        self.last_value = None
+        self.last_time = 0
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def accept(self, value, now):
+        """
+        :param value: decoded signal value
+        :param now: reception time, in seconds
+        :return: True if the value has to be forwarded
+        """
+        last = self.last_value
+
+        if last is not None:
+            elapsed = now - self.last_time
+
+            # a clock going back forwards, better than holding the value
+            if elapsed >= 0 and (self.heartbeat is None or elapsed < self.heartbeat):
+                if elapsed < self.min_interval:
+                    self.suppressed += 1
+                    return False
+
+                try:
+                    unchanged = abs(value - last) <= max(self.deadband, self.deadband_rel * abs(last))
+                except TypeError:
+                    # choices decoded by cantools
+                    unchanged = value == last
+
+                if unchanged:
+                    self.suppressed += 1
+                    return False
+
+        self.last_value = value
+        self.last_time = now
+        self.forwarded += 1
+        return True
+
+
+def filter_from_conf(conf):
+    """
+    :param conf: signal dictionary of dbc_to_sensors.json
+    :return: rx_filter, None if the signal has none of deadband, deadband_rel, min_interval_ms and heartbeat_ms, then
+             every value is forwarded
+    """
+    if not any(key in conf for key in ("deadband", "deadband_rel", "min_interval_ms", "heartbeat_ms")):
+        return None
+
+    heartbeat = conf.get("heartbeat_ms")
+
+    return rx_filter(
+        deadband=conf.get("deadband", 0),
+        deadband_rel=conf.get("deadband_rel", 0),
+        min_interval=conf.get("min_interval_ms", 0) / 1000,
+        heartbeat=None if heartbeat is None else heartbeat / 1000
+    )
+
+
+def build_dispatch_table(dbc, dbc_to_sensors):
+    """
+    builds the CAN RX dispatch table, keyed by arbitration ID, only frames carrying at least one signal routed to a
+    sensor are put in the table
+    :param dbc: cantools database
+    :param dbc_to_sensors: JSON-based dictionary that decodes sensors types for the video
+    :return: dictionary {frame_id: (msg_name, msg_length, signals)}, where signals is a tuple of
+             (signal_name, sensor, compiled_signal, rx_filter or None) tuples, the filters keep the state of the last
+             forwarded values, so every CAN RX path needs its own table
+    """
+    table = dict()
+
+    for msg_name, signals_conf in dbc_to_sensors.items():
+        try:
+            msg = dbc.get_message_by_name(msg_name)
+        except KeyError:
+            continue
+
+        signals = []
+        for signal in msg.signals:
+            conf = signals_conf.get(signal.name)
+            if conf is None or conf.get("sensor") is None:
+                continue
+
+            signals.append((signal.name, conf["sensor"], compile_signal(signal), filter_from_conf(conf)))
+
+        if len(signals) > 0:
+            table[msg.frame_id] = (msg.name, msg.length, tuple(signals))
+
+    return table
+
@@ -0,0 +1,218 @@
+"""
+Offline decoder of the CAN recordings: frames are grouped by arbitration ID and every signal is decoded for all the
+frames of its message at once, with the shift and mask precompiled from the DBC.
+
+Output: one timestamp column and one column per signal for every message, named after the sensor in
+dbc_to_sensors.json or after the signal if it is not routed to a sensor, saved as NPZ ("Message.column" arrays) or, if
+the output ends with .parquet and pyarrow is installed, as a folder with one Parquet file per message.
+
+Usage: ./ffs-decode [-o OUTPUT] [--dbc DBC] [--sensors JSON] INPUT [INPUT ...]
+       INPUT: recordings of src/recorder.py (.ffscan, .gz, .zst), candump -tz text logs, or any log python-can reads
+       (.log, .asc, .blf, .csv, .trc)
+"""
+import os, re, json, argparse
+import numpy as np
+import can, cantools
+
+from .dbc_routing import compile_signal
+from .recorder import HEADER, MAGIC, VERSION, EFF_FLAG, RTR_FLAG, ERR_FLAG, _open_compressed
+
+
+# same layout as recorder.RECORD, payloads are read as little endian integers like in the CAN RX path
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<f8"),
+    ("id", "<u4"),
+    ("dlc", "u1"),
+    ("data", "<u8")
+])
+
+# candump -tz line: (000.000000)  can0  123   [8]  01 02 03 04 05 06 07 08
+CANDUMP_LINE = re.compile(rb"\(\s*([0-9.]+)\)\s+\S+\s+([0-9A-Fa-f]+)\s+\[(\d+)\]((?:\s+[0-9A-Fa-f]{2})*)")
+
+DBC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'policanbent.dbc'))
+SENSORS_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config',
+                                            'dbc_to_sensors.json'))
+
+
+def _records_from_messages(msgs):
+    records = []
+    for msg in msgs:
+        if msg.dlc > 8:
+            continue
+
+        arbitration_id = msg.arbitration_id
+        if msg.is_extended_id:
+            arbitration_id |= EFF_FLAG
+        if msg.is_remote_frame:
+            arbitration_id |= RTR_FLAG
+        if msg.is_error_frame:
+            arbitration_id |= ERR_FLAG
+
+        records.append((msg.timestamp, arbitration_id, msg.dlc, int.from_bytes(msg.data, "little")))
+
+    return np.array(records, dtype=RECORD_DTYPE)
+
+
+def _records_from_candump(path):
+    records = []
+    with open(path, "rb") as file:
+        for line in file:
+            match = CANDUMP_LINE.search(line)
+            if match is None:
+                continue
+
+            timestamp, arbitration_id, dlc, data = match.groups()
+            arbitration_id = int(arbitration_id, 16) | (EFF_FLAG if len(arbitration_id) > 3 else 0)
+            records.append((float(timestamp), arbitration_id, int(dlc), int.from_bytes(bytes.fromhex(data.decode()),
+                                                                                     "little")))
+
+    return np.array(records, dtype=RECORD_DTYPE)
+
+
+def load_records(path):
+    """
+    :param path: CAN log
+    :return: structured array of RECORD_DTYPE
+    """
+    with _open_compressed(path, "rb") as file:
+        head = file.read(HEADER.size)
+
+        if len(head) == HEADER.size and HEADER.unpack(head)[0] == MAGIC:
+            if HEADER.unpack(head)[1] != VERSION:
+                raise ValueError(f"{path} is not a CAN recording v{VERSION}")
+
+            data = file.read()
+            # a recording cut by a power loss may end with a partial record
+            return np.frombuffer(data, dtype=RECORD_DTYPE, count=len(data) // RECORD_DTYPE.itemsize)
+
+    if os.path.splitext(path)[1].lower() in can.LogReader.message_readers:
+        return _records_from_messages(can.LogReader(path))
+
+    # the candump shell logger wrote files named after the start time, without extension
+    return _records_from_candump(path)
+
+
+def extract_column(payloads, compiled):
+    """
+    vectorized extract_signal
+    :param payloads: uint64 array of frame payloads
+    :param compiled: compiled signal, as returned by compile_signal
+    :return: int64 array for unscaled signals, float64 array otherwise
+    """
+    start, mask, sign_bit, scale, offset, is_int = compiled
+
+    raw = (payloads >> np.uint64(start)) & np.uint64(mask)
+    vals = raw.astype(np.int64)
+
+    # 64 bit signals are already wrapped by astype
+    if sign_bit and mask != 0xFFFFFFFFFFFFFFFF:
+        vals[(raw & np.uint64(sign_bit)) != 0] -= mask + 1
+
+    if is_int:
+        return vals
+
+    return vals * scale + offset
+
+
+def decode_records(records, dbc, dbc_to_sensors):
+    """
+    :param records: structured array of RECORD_DTYPE
+    :param dbc: cantools database
+    :param dbc_to_sensors: JSON-based dictionary that decodes sensors types for the video
+    :return: dictionary {message name: {column name: array}}, with a "timestamp" column for every message
+    """
+    ids = records["id"]
+    # error and remote frames carry no signals
+    valid = (ids & np.uint32(RTR_FLAG | ERR_FLAG)) == 0
+
+    order = np.argsort(ids, kind="stable")
+    sorted_ids = ids[order]
+
+    tables = {}
+    for msg in dbc.messages:
+        frame_id = msg.frame_id | (EFF_FLAG if msg.is_extended_frame else 0)
+
+        lo, hi = np.searchsorted(sorted_ids, [frame_id, frame_id + 1])
+        index = order[lo:hi]
+        index = index[valid[index] & (records["dlc"][index] >= msg.length)]
+        if len(index) == 0:
+            continue
+
+        group = records[index]
+        payloads = group["data"]
+        signals_conf = dbc_to_sensors.get(msg.name, {})
+
+        columns = {"timestamp": group["timestamp"]}
+        for signal in msg.signals:
+            sensor = signals_conf.get(signal.name, {}).get("sensor")
+            name = signal.name if sensor is None else sensor
+
+            compiled = compile_signal(signal)
+            if compiled is not None:
+                columns[name] = extract_column(payloads, compiled)
+            else:
+                # signals that can't be precompiled are left to cantools
+                columns[name] = np.array([
+                    dbc.decode_message(msg.frame_id, int(payload).to_bytes(8, "little")[:msg.length],
+                                       decode_choices=False)[signal.name]
+                    for payload in payloads
+                ])
+
+        tables[msg.name] = columns
+
+    return tables
+
+
+def save(tables, path):
+    """
+    :param tables: as returned by decode_records
+    :param path: .npz file, or .parquet folder if pyarrow is installed
+    :return: path written
+    """
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            path = path[:-len(".parquet")] + ".npz"
+        else:
+            os.makedirs(path, exist_ok=True)
+            for msg_name, columns in tables.items():
+                pq.write_table(pa.table(columns), os.path.join(path, f"{msg_name}.parquet"))
+            return path
+
+    np.savez_compressed(path, **{f"{msg_name}.{name}": column
+                                 for msg_name, columns in tables.items() for name, column in columns.items()})
+    return path if path.endswith(".npz") else path + ".npz"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+")
+    parser.add_argument("-o", "--output", default=None, help="default: first input with .npz extension")
+    parser.add_argument("--dbc", default=DBC_PATH)
+    parser.add_argument("--sensors", default=SENSORS_PATH, help="dbc_to_sensors.json")
+    args = parser.parse_args()
+
+    dbc = cantools.database.load_file(args.dbc)
+    with open(args.sensors) as file:
+        dbc_to_sensors = json.load(file)
+
+    records = np.concatenate([load_records(path) for path in args.inputs])
+    tables = decode_records(records, dbc, dbc_to_sensors)
+
+    output = args.output
+    if output is None:
+        output = args.inputs[0]
+        for ext in (".gz", ".zst", ".ffscan"):
+            if output.endswith(ext):
+                output = output[:-len(ext)]
+        output += ".npz"
+
+    output = save(tables, output)
+    print(f"{len(records)} frames, {sum(len(c['timestamp']) for c in tables.values())} decoded into "
+          f"{len(tables)} messages, written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+CAN module harness: runs the asyncio runtime (src/aio_runtime.py) on a python-can virtual bus, or on vcan, with the
+FIFOs in a temporary folder, drives it with synthetic or replayed frames and reads the video FIFO like the video module
+does. No CAN hardware, sudo or ~/bob needed.
+
+For every rate it reports frames sent, frames sent more than 100ms late (the generator can't keep up), samples routed
+to the video FIFO, held back by the deadbands of dbc_to_sensors.json and lost on the way, FIFO latency (binary formats
+carry the producer timestamp), ANT samples written and ANT frames forwarded to the bus (coalesced to one per message
+every tx period). Generator, module and reader share one process, so rates are a lower bound of the module alone.
+
+Usage: python3 -m src.harness [--rates R[,R...]] [--duration S] [--fifo-format FMT] [--replay LOG [--speed X]]
+                              [--ant-rate R] [--interface virtual --channel ffs_harness]
+       rates are frames per second for every DBC message, replayed logs keep their timing scaled by --speed,
+       --speed 0 replays as fast as possible
+"""
+import os, sys, json, random, select, asyncio, tempfile, argparse
+from time import time, sleep, monotonic, monotonic_ns
+from threading import Thread
+import can, cantools
+
+from .aio_runtime import can_module
+from .dbc_routing import build_dispatch_table, extract_signal
+from .recorder import read_records
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+from framing import frame_encoder, frame_decoder
+from tracing import trace
+
+
+DBC_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'policanbent.dbc'))
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config'))
+
+CAN_WRITERS = ["power", "cadence", "ant_speed", "ant_distance", "heartrate"]
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class video_fifo_probe:
+    """
+    reads the video FIFO in a thread, counting samples and FIFO latencies, unlike libs/fifo_reader.py it never blocks
+    on the open or the reads, so it can be stopped at the end of every rate
+    :param path: video FIFO path
+    """
+    def __init__(self, path):
+        self.path = path
+        self.samples = 0
+        self.latencies = []
+        self.running = True
+
+        # O_NONBLOCK so the open doesn't wait for the CAN module
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        decoder = frame_decoder()
+
+        while self.running:
+            readable, _, _ = select.select([self.fd], [], [], 0.1)
+            if not readable:
+                continue
+
+            chunk = os.read(self.fd, 1 << 16)
+            if not chunk:
+                # no writer yet or the CAN module closed the FIFO, select would return immediately
+                sleep(0.01)
+                continue
+
+            now = monotonic_ns()
+            for sensor, _, timestamp in decoder.feed(chunk):
+                self.samples += 1
+                if timestamp is not None:
+                    self.latencies.append(now - timestamp)
+                    trace.record("parse", sensor, timestamp, now)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.fd)
+
+
+def synthetic_frames(dbc, rate, duration):
+    """
+    :return: generator of (send time, can.Message), a random payload for every DBC message at rate frames per second
+    """
+    msgs = dbc.messages
+    period = 1 / rate
+    # messages spread over the period, not all at the same instant
+    offsets = [i * period / len(msgs) for i in range(len(msgs))]
+
+    t = 0
+    while t < duration:
+        for msg, offset in zip(msgs, offsets):
+            data = bytes(random.getrandbits(8) for _ in range(msg.length))
+            yield t + offset, can.Message(arbitration_id=msg.frame_id, is_extended_id=msg.is_extended_frame,
+                                          data=data)
+        t += period
+
+
+def replayed_frames(path, speed, duration):
+    """
+    :return: generator of (send time, can.Message) from a recording or any log python-can reads
+    """
+    if ".ffscan" in path:
+        msgs = read_records(path)
+    else:
+        msgs = can.LogReader(path)
+
+    first = None
+    for msg in msgs:
+        if msg.is_error_frame:
+            continue
+
+        if first is None:
+            first = msg.timestamp
+
+        t = (msg.timestamp - first) / speed if speed > 0 else 0
+        if t >= duration:
+            break
+
+        yield t, msg
+
+
+def ant_writer(path, rate, duration, stats):
+    """
+    writes samples of the sensors sent on the CAN Bus into the ant FIFO, like the ant module
+    """
+    encoder = frame_encoder("text")
+    fd = os.open(path, os.O_WRONLY)
+    start = monotonic()
+    i = 0
+
+    try:
+        while monotonic() - start < duration:
+            sensor = CAN_WRITERS[i % len(CAN_WRITERS)]
+            os.write(fd, encoder.encode(sensor, i % 200))
+            stats["ant_sent"] += 1
+            i += 1
+
+            wait = start + i / rate - monotonic()
+            if wait > 0:
+                sleep(wait)
+    finally:
+        os.close(fd)
+
+
+def run_module(loop, module):
+    try:
+        loop.run_until_complete(module)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.close()
+
+
+def run_trial(args, dbc, dbc_to_sensors, sensors_to_dbc, rate):
+    """
+    :return: dictionary of the trial results
+    """
+    dispatch = build_dispatch_table(dbc, dbc_to_sensors)
+    ant_ids = {dbc.get_message_by_name(sensors_to_dbc[sensor][0]).frame_id
+               for sensor in CAN_WRITERS if sensor in sensors_to_dbc}
+
+    tmp = tempfile.mkdtemp(prefix="ffs_harness_")
+    fifo_can = os.path.join(tmp, "fifo_to_can")
+    fifo_vid = os.path.join(tmp, "fifo_to_video")
+    os.mkfifo(fifo_can)
+    os.mkfifo(fifo_vid)
+
+    module_bus = can.Bus(interface=args.interface, channel=args.channel, receive_own_messages=False)
+    # the module filters see the send time of the generator, so the expected samples match exactly
+    gen_kwargs = {"preserve_timestamps": True} if args.interface == "virtual" else {}
+    gen_bus = can.Bus(interface=args.interface, channel=args.channel, receive_own_messages=False, **gen_kwargs)
+
+    reader = video_fifo_probe(fifo_vid)
+
+    # the module runs in its own thread and event loop, like in its process
+    loop = asyncio.new_event_loop()
+    module = loop.create_task(can_module(module_bus, dbc, sensors_to_dbc, dbc_to_sensors, fifo_can, fifo_vid,
+                                         CAN_WRITERS, args.fifo_format, ("fifo",)))
+    module_thread = Thread(target=run_module, args=(loop, module), daemon=True)
+    module_thread.start()
+    sleep(0.5)
+
+    stats = {"ant_sent": 0}
+    if args.ant_rate > 0:
+        Thread(target=ant_writer, args=(fifo_can, args.ant_rate, args.duration, stats), daemon=True).start()
+
+    if args.replay:
+        frames = replayed_frames(args.replay, args.speed, args.duration)
+    else:
+        frames = synthetic_frames(dbc, rate, args.duration)
+
+    sent = 0
+    expected = 0
+    suppressed = 0
+    late = 0
+    start = monotonic()
+
+    for t, msg in frames:
+        wait = start + t - monotonic()
+        if wait > 0:
+            sleep(wait)
+        elif wait < -0.1:
+            late += 1
+
+        msg.timestamp = time()
+        gen_bus.send(msg)
+        sent += 1
+
+        entry = dispatch.get(msg.arbitration_id)
+        if entry is not None and len(msg.data) >= entry[1]:
+            raw = int.from_bytes(msg.data, "little")
+
+            # same deadbands as the module (dbc_to_sensors.json), suppressed values are not expected
+            for _, _, compiled, rx_filter in entry[2]:
+                if rx_filter is None or compiled is None or rx_filter.accept(extract_signal(raw, compiled),
+                                                                             msg.timestamp):
+                    expected += 1
+                else:
+                    suppressed += 1
+
+    elapsed = monotonic() - start
+
+    # ANT samples come back on the generator bus as CAN frames
+    ant_received = 0
+    deadline = monotonic() + 1.0
+    while monotonic() < deadline:
+        msg = gen_bus.recv(timeout=0.05)
+        if msg is not None and msg.arbitration_id in ant_ids:
+            ant_received += 1
+
+    loop.call_soon_threadsafe(module.cancel)
+    module_thread.join(timeout=2)
+    reader.stop()
+
+    module_bus.shutdown()
+    gen_bus.shutdown()
+    os.remove(fifo_can)
+    os.remove(fifo_vid)
+    os.rmdir(tmp)
+
+    latencies = sorted(reader.latencies)
+    return {
+        "rate": rate,
+        "frames": sent,
+        "frames_per_s": sent / elapsed,
+        "late_frames": late,
+        "samples_expected": expected,
+        "samples_suppressed": suppressed,
+        "samples_received": reader.samples,
+        "samples_lost": expected - reader.samples,
+        "fifo_latency_us": {p: percentile(latencies, q) / 1e3 for p, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "ant_sent": stats["ant_sent"],
+        "ant_forwarded": ant_received
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", default="10,100,1000", help="frames per second for every DBC message")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--fifo-format", default="binary64", choices=("text", "binary32", "binary64"))
+    parser.add_argument("--replay", default=None, help="recording or python-can log to replay")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed factor, 0 for as fast as possible")
+    parser.add_argument("--ant-rate", type=float, default=20, help="ant FIFO samples per second, 0 to disable")
+    parser.add_argument("--interface", default="virtual")
+    parser.add_argument("--channel", default="ffs_harness")
+    parser.add_argument("--trace", action="store_true", help="trace the samples latency (libs/tracing.py) per sensor")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    # the per-sample logs of the module would measure the terminal
+    log.configure(level="warn")
+    # histograms are printed at the end, not dumped
+    trace.configure(enabled=args.trace, output="", name="harness")
+
+    dbc = cantools.database.load_file(DBC_PATH)
+    with open(f"{CONFIG_PATH}/dbc_to_sensors.json") as file:
+        dbc_to_sensors = json.load(file)
+    with open(f"{CONFIG_PATH}/sensors_to_dbc.json") as file:
+        sensors_to_dbc = json.load(file)
+
+    rates = [None] if args.replay else [float(rate) for rate in args.rates.split(",")]
+    results = [run_trial(args, dbc, dbc_to_sensors, sensors_to_dbc, rate) for rate in rates]
+
+    if args.trace:
+        # histograms of all the trials together
+        latencies = trace.snapshot()
+        if args.json:
+            results.append({"trace_latency_us": latencies})
+        else:
+            for sensor, stages in latencies.items():
+                print(f"{sensor}: " + ", ".join(f"{stage} p50 {s['p50']}us p99 {s['p99']}us"
+                                                for stage, s in stages.items()))
+            print()
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print(f"{'rate/msg':>9}{'frames/s':>10}{'late':>7}{'samples':>9}{'supp':>8}{'lost':>7}"
+          f"{'lat p50':>10}{'p95':>9}{'p99':>9}{'ant sent':>10}{'fwd':>6}")
+    for r in results:
+        lat = r["fifo_latency_us"]
+        print(f"{str(r['rate']):>9}{r['frames_per_s']:>10.0f}{r['late_frames']:>7}{r['samples_received']:>9}"
+              f"{r['samples_suppressed']:>8}{r['samples_lost']:>7}{lat['p50']:>8.0f}us{lat['p95']:>7.0f}us{lat['p99']:>7.0f}us"
+              f"{r['ant_sent']:>10}{r['ant_forwarded']:>6}")
+
+
+if __name__ == '__main__':
+    main()
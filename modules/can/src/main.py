@@ -1,17 +1,28 @@
 import os, sys, stat
-import can, cantools
+import can
 
 import json
+import asyncio
 
-from threading import Thread
+from time import sleep
 from multiprocessing import Process, Pipe 
+from threading import Thread
 import subprocess as sp
 
-from .can_msg_manager import can_msg_manager
+from .can_msg_manager import can_msg_manager, tee_writer
+from .tx_scheduler import tx_from_conf
+from .stages import queue_from_conf, forwarder, fifo_writer
+from .dbc_cache import load_database
+from .recorder import recorder_from_conf
 
 # append into path the libs folder, so that Python will find them
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
 from log import log
+from tracing import trace
+from startup import startup
+from framing import frame_encoder, frame_decoder
+from fifo_reader import fifo_reader
+from telemetry_store import telemetry_store
 
 
 # useful paths as strings
@@ -20,33 +31,54 @@ ffs_path = f"{home_path}/ffs"
 config_path = f"{ffs_path}/config"
 
 
-# fifo to can creation
 FIFO_TO_CAN = "fifo_to_can"
 FIFO_CAN = f"{home_path}/bob/{FIFO_TO_CAN}"
 
-if os.path.exists(FIFO_CAN):
-    if not stat.S_ISFIFO(os.stat(FIFO_CAN).st_mode):
-        os.remove(FIFO_CAN)
-        os.mkfifo(FIFO_CAN)
-else:
-    os.mkfifo(FIFO_CAN)
-
-# fifo to video creation
 FIFO_TO_VIDEO = "fifo_to_video"
 FIFO_VID = f"{home_path}/bob/{FIFO_TO_VIDEO}"
 
+# latest value table read by the video module at its own frame rate
+TELEMETRY_STORE = f"{home_path}/bob/telemetry"
+
 can_writers = ["power", "cadence", "ant_speed", "ant_distance", "heartrate"]
 
-if os.path.exists(FIFO_VID):
-    if not stat.S_ISFIFO(os.stat(FIFO_VID).st_mode):
-        os.remove(FIFO_VID)
-        os.mkfifo(FIFO_VID)
-else:
-    os.mkfifo(FIFO_VID)
+
+def make_fifo(path):
+    """
+    creates the FIFO, replacing any other file with the same path
+    """
+    if os.path.exists(path):
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            os.remove(path)
+            os.mkfifo(path)
+    else:
+        os.mkfifo(path)
 
 
-def can_logger():
-    sp.call("./can_logger.sh")
+def open_bus(bus_conf):
+    """
+    opens the CAN Bus, retrying until it is available
+    :param bus_conf: "bus" dictionary of can.json, python-can interface, channel and bitrate, and the script that
+                     (re)configures the interface, null for interfaces that don't need it (e.g. virtual, vcan)
+    """
+    reconnect = bus_conf.get("reconnect", "./can_reconnect.sh")
+    if reconnect:
+        sp.call(reconnect)
+
+    while True:
+        try:
+            return can.Bus(
+                    interface=bus_conf.get("interface", "socketcan"),
+                    channel=bus_conf.get("channel", "can0"),
+                    bitrate=bus_conf.get("bitrate", 500000),
+                    receive_own_messages=False
+            )
+        except Exception:
+            log.err(f"CAN MANAGER: no CAN connection, retrying...")
+            if reconnect:
+                sp.call(reconnect)
+            else:
+                sleep(1)
 
 
 def json_to_dict(path: str):
@@ -64,126 +96,217 @@ def json_to_dict(path: str):
     return res
 
 
-def ant_reader(writer):
+def ant_reader(writer, fifo_can=FIFO_CAN, queues_conf={}):
     """
     reads the ant-can FIFO and writes the given messages on the internal ant Pipe that sends the messages that have to
     be sent on the CAN Bus
     :param writer: writer of Pipe that sends FIFO-read messages to the can_msg_manager function to send them on the CAN
-                   Bus
+                   Bus, samples go through the "ant" stage queue, so reading the FIFO never waits for the Pipe
+    :param fifo_can: ant FIFO path
+    :param queues_conf: "queues" dictionary of can.json
     """
+    reader = fifo_reader(fifo_can, frame_decoder())
+
+    queue = queue_from_conf("ant", queues_conf)
+    Thread(target=forwarder, args=(queue, writer), daemon=True).start()
+
     while True:
         try:
-            with open(FIFO_CAN, 'rb', 0) as fifo_can:
-                for line in fifo_can:
-                    try:    
-                        sensor, value = line.decode().rstrip().split(":")
-                        log.info(f"{sensor}: {value}")
+            samples = reader.read_batch()
+        except Exception as e:
+            log.err(f"ANT READER: {e}")
+            reader.close()
+            sleep(1)
+            continue
 
-                        if sensor in can_writers:
-                            writer.send((sensor, value))
+        for sensor, value, _ in samples:
+            log.info(f"{sensor}: {value}", every=1, key=sensor)
 
-                    except Exception as e:
-                        log.err(f"ANT READER (decode): {e}")
+            if sensor in can_writers:
+                queue.send((sensor, value))
 
-        except Exception as e:
-            log.err(f"ANT READER: {e}")
 
-    return
+def pipe_reader(reader, queue):
+    """
+    moves the sample lists of a Pipe into a stage queue, so the Pipe is always drained and its writer never waits,
+    run it as a daemon thread
+    :param reader: reader of the Pipe
+    :param queue: stage_queue read by the consumer stage
+    """
+    while True:
+        try:
+            batch = reader.recv()
+        except EOFError:
+            log.err(f"PIPE READER {queue.name}: Pipe closed")
+            break
 
+        for data in batch:
+            # (sensor, value, reception time) when tracing
+            if len(data) > 2:
+                trace.record("pipe", data[0], data[2])
+            queue.send(data)
 
-def vid_writer(reader):
+
+def vid_writer(reader, fifo_format="text", fifo_vid=FIFO_VID, queues_conf={}, fifo_timeout=0.1):
     """
     reads the internal video Pipe and then send the read messages on the FIFO directed to the video module
-    :param reader: reader of the video Pipe, read data are then sent to the video FIFO
+    :param reader: reader of the video Pipe, read data are then sent to the video FIFO through the "video_fifo" stage
+                   queue
+    :param fifo_format: video FIFO format, "text", "binary32" or "binary64" (see libs/framing.py)
+    :param fifo_vid: video FIFO path
+    :param queues_conf: "queues" dictionary of can.json
+    :param fifo_timeout: seconds a write waits for a full video FIFO before dropping the samples
     """
-    fifo_vid = open(FIFO_VID, 'wb', 0)
-    log.info(f"VID WRITER - {FIFO_VID} opened")
+    encoder = frame_encoder(fifo_format, timestamps=trace.enabled)
+    fifo = fifo_writer(fifo_vid, encoder, timeout=fifo_timeout)
+
+    queue = queue_from_conf("video_fifo", queues_conf)
+    Thread(target=pipe_reader, args=(reader, queue), daemon=True).start()
 
+    dropped = 0
     while True:
-        if reader.poll():
-            data = reader.recv()
+        batch = queue.get_batch(timeout=queue.stats_interval)
 
-            payload = f"{data[0]}:{data[1]}\n"
-            log.info(f"VID WRITER: sending data - {data[0]}: {data[1]}")
+        if fifo.dropped > dropped:
+            log.warn(f"VID WRITER: {fifo.dropped} samples dropped, video FIFO closed or full", every=60)
+            dropped = fifo.dropped
 
-            try:
-                fifo_vid.write(payload.encode())
-            except Exception as e:
-                log.err(f"VID WRITER: {e}")
+        if len(batch) == 0:
+            continue
 
+        payload = bytearray()
+        for data in batch:
+            origin = data[2] if len(data) > 2 else None
+            encoded = encoder.encode(data[0], data[1], origin)
+            if len(encoded) == 0:
+                log.warn(f"VID WRITER: {data[0]} is not in SENSORS, {encoder.unknown[data[0]]} samples not sent",
+                         every=60, key=data[0])
+                continue
+            payload += encoded
+            log.info(f"VID WRITER: sending data - {data[0]}: {data[1]}", every=1, key=data[0])
 
-def can_manager(bus, reader_ant, writer_vid):
+        if fifo.write(payload, len(batch)) and trace.enabled:
+            for data in batch:
+                trace.record("fifo", data[0], data[2] if len(data) > 2 else None)
+
+
+def can_manager(bus, reader_ant, writer_vid, video_output=("fifo",), recorder_conf={}, tx_conf={}, queues_conf={}):
     """
     manages CAN Bus communication with other boards, both reading and writing on the bus
     :param reader_ant: reader of the ant Pipe, read data are then sent to can_msg_manager to send them on the CAN Bus
     :param writer_vid: writer of the video Pipe, used to send the CAN-received data to the process managing the video
-                       FIFO
+                       FIFO through the "can_rx" stage queue, so the Notifier thread never waits for the Pipe, None if
+                       the FIFO is not used
+    :param video_output: where CAN-received data are sent to the video module, "fifo" and/or "store"
+    :param recorder_conf: "recorder" dictionary of can.json
+    :param tx_conf: "tx" dictionary of can.json
+    :param queues_conf: "queues" dictionary of can.json
     """
-    dbc = cantools.database.load_file('./policanbent.dbc')
-    
-
     sensors_to_dbc = json_to_dict(f"{config_path}/sensors_to_dbc.json")
     dbc_to_sensors = json_to_dict(f"{config_path}/dbc_to_sensors.json")
-    
-    msg_handler = can_msg_manager(writer_vid, dbc_to_sensors, dbc)
-    notifier = can.Notifier(bus, [msg_handler])
 
+    dbc, dispatch = load_database('./policanbent.dbc', dbc_to_sensors)
+    startup.mark("dbc")
+
+    writers = []
+    if writer_vid is not None:
+        queue = queue_from_conf("can_rx", queues_conf)
+        Thread(target=forwarder, args=(queue, writer_vid), daemon=True).start()
+        writers.append(queue)
+    if "store" in video_output:
+        # written straight from the Notifier thread, no Pipe hop
+        writers.append(telemetry_store(TELEMETRY_STORE, writer=True))
+
+    msg_handler = can_msg_manager(tee_writer(writers), dbc_to_sensors, dbc, dispatch)
+    listeners = [msg_handler]
+
+    recorder = recorder_from_conf(recorder_conf)
+    if recorder is not None:
+        listeners.append(recorder)
+
+    notifier = can.Notifier(bus, listeners)
+
+    tx = tx_from_conf(bus, dbc, sensors_to_dbc, can_writers, tx_conf)
+    delay = None
+
+    # the CAN socket is served by the Notifier thread, this process only waits on the ant Pipe or for the next due
+    # message, poll(None) waits for the Pipe only
     while True:
-        if reader_ant.poll():
-            data = reader_ant.recv()    # data encoded as a two elements tuple in
-                                        # ant_reader:
-                                        #  - data[0] -> sensor
-                                        #  - data[1] -> value
+        try:
+            # list of two elements tuples sent by the ant_reader forwarder:
+            #  - data[0] -> sensor
+            #  - data[1] -> value
+            batch = reader_ant.recv() if reader_ant.poll(delay) else []
+        except EOFError:
+            log.err(f"CAN MANAGER: ant Pipe closed")
+            break
 
-            log.info(f"ANT READ: {data[0]}:{data[1]}\n")
+        for data in batch:
+            log.info(f"ANT READ: {data[0]}:{data[1]}", every=1, key=data[0])
 
-            id_name = sensors_to_dbc[data[0]][0]
-            sig_name = sensors_to_dbc[data[0]][1]
-            pl = dbc.encode_message(id_name, {sig_name: float(data[1])})
-            id_frame = dbc.get_message_by_name(id_name).frame_id
-            can_frame = can.Message(arbitration_id=id_frame, is_extended_id=False, data=pl)
+            try:
+                tx.update(data[0], data[1])
+            except Exception as e:
+                log.err(f"CAN MANAGER: {e}", every=1, key=data[0])
 
-            bus.send(can_frame, timeout=0.2)
+        delay = tx.poll()
 
+    notifier.stop()
+    if recorder is not None:
+        recorder.stop()
     return
 
 
 def main():
-    sp.call("./can_reconnect.sh")
+    trace.configure(name="can")
+    startup.configure(name="can", last="first_can_rx")
+    startup.mark("imports")
 
-    flg = 0
-    while flg == 0:
-        try:
-            bus = can.Bus(
-                    interface='socketcan',
-                    channel='can0',
-                    bitrate=500000,
-                    receive_own_messages=False
-            )
+    can_conf = json_to_dict(f"{config_path}/can.json")
+    fifo_format = can_conf.get("fifo_format", "text")
+    video_output = can_conf.get("video_output", ["fifo"])
+    recorder_conf = can_conf.get("recorder", {})
+    tx_conf = can_conf.get("tx", {})
+    queues_conf = can_conf.get("queues", {})
 
-            flg = 1
-        except:
-            log.err(f"CAN MANAGER: no CAN connection, retrying...")
-            sp.call("./can_reconnect.sh")
-        
+    make_fifo(FIFO_CAN)
+    make_fifo(FIFO_VID)
+
+    bus = open_bus(can_conf.get("bus", {}))
+    startup.mark("bus")
+
+    if can_conf.get("runtime", "process") == "asyncio":
+        from .aio_runtime import can_module
 
-    thread_can_logger = Thread(target=can_logger)
-    thread_can_logger.start()
+        sensors_to_dbc = json_to_dict(f"{config_path}/sensors_to_dbc.json")
+        dbc_to_sensors = json_to_dict(f"{config_path}/dbc_to_sensors.json")
 
+        dbc, dispatch = load_database('./policanbent.dbc', dbc_to_sensors)
+        startup.mark("dbc")
+
+        asyncio.run(can_module(bus, dbc, sensors_to_dbc, dbc_to_sensors, FIFO_CAN, FIFO_VID, can_writers,
+                               fifo_format, video_output, TELEMETRY_STORE, recorder_conf, tx_conf, dispatch))
+        return
+
+    # process runtime, kept as a fallback
     reader_ant, writer_ant = Pipe(duplex=False)
-    reader_vid, writer_vid = Pipe(duplex=False)
+    procs = []
+
+    if "fifo" in video_output:
+        reader_vid, writer_vid = Pipe(duplex=False)
+        procs.append(Process(target=vid_writer, args=(reader_vid, fifo_format, FIFO_VID, queues_conf,)))
+    else:
+        writer_vid = None
 
-    can_manager_proc = Process(target=can_manager, args=(bus, reader_ant, writer_vid,))
-    vid_writer_proc  = Process(target=vid_writer, args=(reader_vid,))
-    ant_reader_proc  = Process(target=ant_reader, args=(writer_ant,))
+    procs.append(Process(target=can_manager, args=(bus, reader_ant, writer_vid, video_output, recorder_conf, tx_conf,
+                                                   queues_conf,)))
+    procs.append(Process(target=ant_reader, args=(writer_ant, FIFO_CAN, queues_conf,)))
 
-    can_manager_proc.start()
-    vid_writer_proc.start()
-    ant_reader_proc.start()
+    for proc in procs:
+        proc.start()
 
-    can_manager_proc.join()
-    vid_writer_proc.join()
-    ant_reader_proc.join()
+    for proc in procs:
+        proc.join()
 
 
 if __name__ == '__main__':
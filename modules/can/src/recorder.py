@@ -0,0 +1,294 @@
+"""
+CAN Bus recorder: a Listener of the module Notifier that stores every frame in a compact binary format, rotated by
+size or time and optionally compressed, and converted back to candump/ASC/BLF with python-can when needed.
+
+Usage: python3 -m src.recorder INPUT OUTPUT
+       OUTPUT format from its extension: .log (candump -L), .asc, .blf, .csv, ...
+"""
+import os, sys, gzip, shutil, struct, argparse
+from time import monotonic, strftime
+from threading import Thread, Lock, Event
+import can
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+MAGIC = b"FFSC"
+VERSION = 1
+HEADER = struct.Struct("<4sB")
+
+# record: timestamp in seconds, arbitration ID with the socketcan flags, DLC, payload padded to 8 bytes
+RECORD = struct.Struct("<dIB8s")
+
+EFF_FLAG = 0x80000000
+RTR_FLAG = 0x40000000
+ERR_FLAG = 0x20000000
+
+EXTENSION = ".ffscan"
+COMPRESSIONS = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+
+
+def _open_compressed(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+
+    if path.endswith(".zst"):
+        import zstandard
+        if "r" in mode:
+            return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+        return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+
+    return open(path, mode)
+
+
+def compress(path, compression):
+    """
+    compresses a closed recording and removes it
+    :param path: recording path
+    :param compression: "gzip" or "zstd"
+    :return: compressed file path
+    """
+    out_path = path + COMPRESSIONS[compression]
+
+    with open(path, "rb") as src, _open_compressed(out_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+    os.remove(path)
+    return out_path
+
+
+class can_recorder(can.Listener):
+    """
+    records the frames received by the Notifier it is attached to, in files named after their start time
+    :param directory: folder of the recordings
+    :param max_bytes: size after which a new file is started
+    :param max_seconds: time after which a new file is started
+    :param compression: None, "gzip" or "zstd", applied to a file after the rotation in a separate thread
+    :param buffer_size: bytes buffered before writing to the file
+    :param flush_interval: maximum seconds frames stay in the buffer, i.e. lost if the board is switched off, a
+                           thread flushes (and rotates by time) also while no frame arrives
+    """
+    def __init__(self, directory, max_bytes=16 << 20, max_seconds=3600, compression=None, buffer_size=1 << 16,
+                 flush_interval=5.0):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression {compression}")
+
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                log.warn(f"CAN RECORDER: zstandard is not installed, using gzip")
+                compression = "gzip"
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.file = None
+        self.recorded = 0
+        self.skipped = 0
+        # the file is shared by the Notifier thread and the flush thread
+        self.lock = Lock()
+        self._open()
+
+        self.stopped = Event()
+        self.flusher = Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _open(self):
+        name = strftime("%Y-%m-%dT%H:%M:%S%z")
+        self.path = os.path.join(self.directory, name + EXTENSION)
+
+        # more rotations in the same second
+        n = 1
+        while os.path.exists(self.path) or os.path.exists(self.path + COMPRESSIONS[self.compression]):
+            self.path = os.path.join(self.directory, f"{name}_{n}{EXTENSION}")
+            n += 1
+
+        self.file = open(self.path, "wb", buffering=self.buffer_size)
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+        self.written = HEADER.size
+        self.flushed = 0
+        self.opened = monotonic()
+        self.last_flush = self.opened
+
+        log.info(f"CAN RECORDER - recording to {self.path}")
+
+    def _close(self, background=True):
+        self.file.close()
+        self.file = None
+
+        if self.compression is not None:
+            if background:
+                # compressing takes seconds, the Notifier must keep serving the bus
+                Thread(target=self._compress, args=(self.path,), daemon=True).start()
+            else:
+                self._compress(self.path)
+
+    def _compress(self, path):
+        try:
+            compress(path, self.compression)
+        except Exception as e:
+            log.err(f"CAN RECORDER (compression): {e}")
+
+    def rotate(self):
+        with self.lock:
+            self._rotate()
+
+    def _rotate(self):
+        self._close()
+        self._open()
+
+    def _flush(self, now):
+        if self.written > self.flushed:
+            self.file.flush()
+            self.flushed = self.written
+        self.last_flush = now
+
+    def _flush_loop(self):
+        # on a quiet bus no frame triggers the flush or the rotation
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                with self.lock:
+                    if self.file is None:
+                        continue
+
+                    now = monotonic()
+                    if now - self.opened >= self.max_seconds and self.written > HEADER.size:
+                        self._rotate()
+                    elif now - self.last_flush >= self.flush_interval:
+                        self._flush(now)
+            except Exception as e:
+                log.err(f"CAN RECORDER (flush): {e}", every=60)
+
+    def on_message_received(self, msg):
+        if msg.dlc > 8:
+            # CAN FD payloads don't fit the record
+            self.skipped += 1
+            return
+
+        arbitration_id = msg.arbitration_id
+        if msg.is_extended_id:
+            arbitration_id |= EFF_FLAG
+        if msg.is_remote_frame:
+            arbitration_id |= RTR_FLAG
+        if msg.is_error_frame:
+            arbitration_id |= ERR_FLAG
+
+        record = RECORD.pack(msg.timestamp, arbitration_id, msg.dlc, bytes(msg.data))
+
+        with self.lock:
+            if self.file is None:
+                return
+
+            self.file.write(record)
+            self.written += RECORD.size
+            self.recorded += 1
+
+            now = monotonic()
+            if self.written >= self.max_bytes or now - self.opened >= self.max_seconds:
+                self._rotate()
+            elif now - self.last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def on_error(self, exc):
+        log.err(f"CAN RECORDER: {exc}")
+
+    def stop(self):
+        self.stopped.set()
+        self.flusher.join()
+
+        with self.lock:
+            if self.file is not None:
+                self._close(background=False)
+
+
+def recorder_from_conf(conf):
+    """
+    :param conf: "recorder" dictionary of can.json
+    :return: can_recorder, None if disabled
+    """
+    if not conf.get("enabled", False):
+        return None
+
+    return can_recorder(
+        os.path.expanduser(conf.get("directory", "~/bob/can_logs")),
+        max_bytes=int(conf.get("max_mb", 16) * (1 << 20)),
+        max_seconds=conf.get("max_minutes", 60) * 60,
+        compression=conf.get("compression")
+    )
+
+
+def read_records(path):
+    """
+    :param path: recording, compressed or not
+    :return: generator of the recorded can.Message
+    """
+    with _open_compressed(path, "rb") as file:
+        magic, version = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a CAN recording v{VERSION}")
+
+        rest = b""
+        while True:
+            chunk = file.read(RECORD.size * 4096)
+            if not chunk:
+                # a recording cut by a power loss may end with a partial record, it's left out
+                break
+
+            chunk = rest + chunk
+            end = len(chunk) - len(chunk) % RECORD.size
+            rest = chunk[end:]
+
+            for timestamp, arbitration_id, dlc, data in RECORD.iter_unpack(chunk[:end]):
+                yield can.Message(
+                    timestamp=timestamp,
+                    arbitration_id=arbitration_id & 0x1FFFFFFF,
+                    is_extended_id=bool(arbitration_id & EFF_FLAG),
+                    is_remote_frame=bool(arbitration_id & RTR_FLAG),
+                    is_error_frame=bool(arbitration_id & ERR_FLAG),
+                    dlc=dlc,
+                    data=data[:dlc],
+                    channel="can0"
+                )
+
+
+def convert(path, out_path):
+    """
+    :param path: recording, compressed or not
+    :param out_path: output file, the format is chosen by can.Logger from the extension
+    :return: number of frames converted
+    """
+    n = 0
+    with can.Logger(out_path) as logger:
+        for msg in read_records(path):
+            logger.on_message_received(msg)
+            n += 1
+
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input")
+    parser.add_argument("output")
+    args = parser.parse_args()
+
+    n = convert(args.input, args.output)
+    print(f"{n} frames written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import os, sys, errno, select
+from collections import deque, OrderedDict
+from threading import Lock, Condition
+from time import monotonic
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+POLICIES = ("drop_oldest", "keep_latest", "block")
+
+
+class stage_queue:
+    """
+    bounded queue between two stages of the process runtime, what happens when it is full depends on the policy:
+     - drop_oldest: the oldest sample is dropped
+     - keep_latest: only the latest sample of every sensor is queued, a new sample replaces the queued one of the same
+       sensor in its place, size bounds the number of sensors
+     - block: send waits for room, the producer stage gets the backpressure
+    :param name: stage name, used in the logs
+    :param size: maximum samples queued
+    :param policy: one of POLICIES
+    :param stats_interval: seconds between two counters logs, written by the consumer
+    """
+    def __init__(self, name, size=1024, policy="drop_oldest", stats_interval=60):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown queue policy {policy}")
+
+        self.name = name
+        self.size = size
+        self.policy = policy
+        self.stats_interval = stats_interval
+
+        self.items = OrderedDict() if policy == "keep_latest" else deque()
+        lock = Lock()
+        self.not_empty = Condition(lock)
+        self.not_full = Condition(lock)
+
+        self.queued = 0
+        self.dropped = 0
+        self.last_stats = monotonic()
+
+    def send(self, data):
+        """
+        same interface as the Pipe writer
+        :param data: (sensor, value) tuple, or (sensor, value, reception time) when tracing
+        """
+        with self.not_empty:
+            self.queued += 1
+
+            if self.policy == "keep_latest":
+                if data[0] in self.items:
+                    self.dropped += 1
+                elif len(self.items) >= self.size:
+                    self.items.popitem(last=False)
+                    self.dropped += 1
+                self.items[data[0]] = data
+            else:
+                if len(self.items) >= self.size:
+                    if self.policy == "block":
+                        while len(self.items) >= self.size:
+                            self.not_full.wait()
+                    else:
+                        self.items.popleft()
+                        self.dropped += 1
+                self.items.append(data)
+
+            self.not_empty.notify()
+
+    def get_batch(self, timeout=None, max_items=256):
+        """
+        :param timeout: seconds waited for a sample, None waits forever
+        :param max_items: maximum samples returned
+        :return: list of the queued samples, oldest first, empty if none was queued before timeout
+        """
+        with self.not_empty:
+            if len(self.items) == 0:
+                self.not_empty.wait(timeout)
+
+            batch = []
+            while len(self.items) > 0 and len(batch) < max_items:
+                if self.policy == "keep_latest":
+                    batch.append(self.items.popitem(last=False)[1])
+                else:
+                    batch.append(self.items.popleft())
+
+            if len(batch) > 0 and self.policy == "block":
+                self.not_full.notify_all()
+
+        now = monotonic()
+        if now - self.last_stats >= self.stats_interval:
+            stats = self.stats()
+            log.info(f"QUEUE {self.name}: {stats['queued']} samples queued, {stats['dropped']} dropped ({self.policy}), "
+                     f"{stats['depth']} waiting")
+            self.last_stats = now
+
+        return batch
+
+    def stats(self):
+        """
+        :return: dictionary of the counters since the start and of the samples waiting
+        """
+        return {"queued": self.queued, "dropped": self.dropped, "depth": len(self.items)}
+
+
+def queue_from_conf(name, queues_conf):
+    """
+    :param name: stage name, key of queues_conf
+    :param queues_conf: "queues" dictionary of can.json
+    :return: stage_queue
+    """
+    conf = queues_conf.get(name, {})
+    return stage_queue(name, conf.get("size", 1024), conf.get("policy", "drop_oldest"))
+
+
+def forwarder(queue, writer):
+    """
+    moves the samples of queue to a Pipe, one list of samples per send, only this thread waits for the Pipe, run it as
+    a daemon thread
+    :param queue: stage_queue filled by the producer stage
+    :param writer: writer of the Pipe to the consumer stage
+    """
+    while True:
+        batch = queue.get_batch(timeout=queue.stats_interval)
+        if len(batch) == 0:
+            continue
+
+        try:
+            writer.send(batch)
+        except Exception as e:
+            log.err(f"FORWARDER {queue.name}: {e}", every=1)
+
+
+class fifo_writer:
+    """
+    non-blocking writer of the video FIFO for the process runtime: the FIFO is opened with O_NONBLOCK, so while the
+    video module is not there (ENXIO) or after it went away (EPIPE) samples are dropped and the FIFO is opened again,
+    CAN reception is never stopped
+    :param path: video FIFO path
+    :param encoder: frame_encoder of the video FIFO format, its header is written at every open
+    :param timeout: seconds a write waits for a full FIFO, the payload is dropped after that
+    :param reopen_interval: seconds between two attempts to open the FIFO while there is no reader
+    """
+    def __init__(self, path, encoder, timeout=0.1, reopen_interval=1.0):
+        self.path = path
+        self.encoder = encoder
+        self.timeout = timeout
+        self.reopen_interval = reopen_interval
+
+        self.fd = None
+        self.last_open = float("-inf")
+        # bytes of a payload the FIFO didn't take, they are written before anything else to keep records whole
+        self.pending = bytearray()
+        self.dropped = 0
+
+    def _open(self):
+        now = monotonic()
+        if now - self.last_open < self.reopen_interval:
+            return False
+        self.last_open = now
+
+        try:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                log.err(f"FIFO WRITER: {e}", every=10)
+            return False
+
+        log.info(f"FIFO WRITER - {self.path} opened")
+        self.pending += self.encoder.header()
+        return True
+
+    def _close(self):
+        os.close(self.fd)
+        self.fd = None
+        self.pending.clear()
+
+    def _drain(self, deadline):
+        """
+        :return: True if everything pending was written before deadline
+        """
+        while len(self.pending) > 0:
+            try:
+                n = os.write(self.fd, self.pending)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                # EPIPE, the video module went away
+                log.err(f"FIFO WRITER: {e}", every=10)
+                self._close()
+                return False
+
+            del self.pending[:n]
+            if len(self.pending) > 0:
+                left = deadline - monotonic()
+                if left <= 0 or not select.select([], [self.fd], [], left)[1]:
+                    return False
+
+        return True
+
+    def write(self, payload, samples=1):
+        """
+        :param payload: encoded samples
+        :param samples: number of samples in payload, for the drop counter
+        :return: False if the payload was dropped
+        """
+        if self.fd is None and not self._open():
+            self.dropped += samples
+            return False
+
+        deadline = monotonic() + self.timeout
+
+        # what is left of the previous payload goes first, the new one is dropped if the FIFO is still full
+        if len(self.pending) > 0 and not self._drain(deadline):
+            self.dropped += samples
+            return False
+
+        self.pending += payload
+        # a partial write keeps the rest pending, the payload is not dropped unless the reader goes away
+        self._drain(deadline)
+        if self.fd is None:
+            self.dropped += samples
+            return False
+
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            self._close()
@@ -0,0 +1,162 @@
+import os, sys
+from time import monotonic
+import can
+
+from .dbc_routing import compile_signal, encode_signal
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+class _tx_message:
+    """
+    transmit state of a DBC message: latest payload, whether it was sent, and when
+    """
+    __slots__ = ("name", "frame_id", "is_extended", "length", "period", "payload", "values", "pending", "last_sent")
+
+    def __init__(self, msg, period):
+        self.name = msg.name
+        self.frame_id = msg.frame_id
+        self.is_extended = msg.is_extended_frame
+        self.length = msg.length
+        self.period = period
+
+        # payload as a little endian integer, signals are or-ed into it
+        self.payload = 0
+        # physical values of all the signals, only for messages with signals cantools has to encode
+        self.values = None
+        self.pending = False
+        self.last_sent = float("-inf")
+
+
+class tx_scheduler:
+    """
+    CAN TX path of the ANT data: an update only rewrites the payload of the message carrying the sensor, poll sends
+    every updated message at most once per period with its latest payload, so the updates received in the meantime
+    are coalesced. Sends never block: a full transmit queue fails the send and the message is retried a period later.
+    update and poll must be called from the same thread, or from the event loop
+    :param bus: python-can bus
+    :param dbc: cantools database
+    :param sensors_to_dbc: JSON-based dictionary that encodes sensors into CAN messages
+    :param sensors: sensors that can be sent (can_writers), None for all the sensors in sensors_to_dbc
+    :param period: default seconds between two sends of the same message
+    :param periods: dictionary {message name: seconds} of the messages with a different period
+    :param stats_interval: seconds between two counters logs
+    """
+    def __init__(self, bus, dbc, sensors_to_dbc, sensors=None, period=0.1, periods={}, stats_interval=60):
+        self.bus = bus
+        self.dbc = dbc
+        self.stats_interval = stats_interval
+
+        self.messages = {}
+        # sensor -> (message, signal name, compiled signal, mask at the signal position, minimum, maximum)
+        self.encoders = {}
+
+        for sensor in (sensors_to_dbc if sensors is None else sensors):
+            msg_name, sig_name = sensors_to_dbc[sensor]
+            msg = dbc.get_message_by_name(msg_name)
+            signal = msg.get_signal_by_name(sig_name)
+
+            message = self.messages.get(msg_name)
+            if message is None:
+                message = _tx_message(msg, periods.get(msg_name, period))
+                self.messages[msg_name] = message
+
+            compiled = compile_signal(signal)
+            if compiled is None:
+                # left to cantools, that needs the values of all the signals of the message
+                message.values = msg.decode(bytes(msg.length), decode_choices=False)
+                field = 0
+            else:
+                field = compiled[1] << compiled[0]
+
+            self.encoders[sensor] = (message, sig_name, compiled, field, signal.minimum, signal.maximum)
+
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.last_stats = monotonic()
+
+    def update(self, sensor, value):
+        """
+        :param sensor: sensor name, one of sensors
+        :param value: sensor value
+        :raise KeyError: if the sensor is not sent on the CAN Bus
+        :raise ValueError: if the value is out of the DBC signal range
+        """
+        message, sig_name, compiled, field, minimum, maximum = self.encoders[sensor]
+
+        value = float(value)
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+            raise ValueError(f"{sensor} {value} out of {sig_name} range [{minimum}, {maximum}]")
+
+        if compiled is not None:
+            message.payload = (message.payload & ~field) | encode_signal(value, compiled)
+        else:
+            message.values[sig_name] = value
+            data = self.dbc.get_message_by_name(message.name).encode(message.values)
+            message.payload = int.from_bytes(data, "little")
+
+        if message.pending:
+            self.coalesced += 1
+        message.pending = True
+
+    def poll(self, now=None):
+        """
+        sends the updated messages whose period has elapsed
+        :param now: monotonic time, default now
+        :return: seconds until the next send is due, None if no message is waiting, the caller can wait for new
+                 updates or for that long before the next poll
+        """
+        if now is None:
+            now = monotonic()
+
+        next_due = None
+        for message in self.messages.values():
+            if not message.pending:
+                continue
+
+            due = message.last_sent + message.period
+            if now >= due:
+                try:
+                    self.bus.send(can.Message(arbitration_id=message.frame_id, is_extended_id=message.is_extended,
+                                              data=message.payload.to_bytes(message.length, "little")), timeout=0)
+                except can.CanError as e:
+                    self.failed += 1
+                    log.err(f"CAN TX: {e}", every=1, key=message.name)
+                else:
+                    self.sent += 1
+                    message.pending = False
+
+                message.last_sent = now
+                if not message.pending:
+                    continue
+                due = now + message.period
+
+            if next_due is None or due < next_due:
+                next_due = due
+
+        if now - self.last_stats >= self.stats_interval:
+            log.info(f"CAN TX: {self.sent} frames sent, {self.coalesced} updates coalesced, {self.failed} sends failed")
+            self.last_stats = now
+
+        return None if next_due is None else next_due - now
+
+    def stats(self):
+        """
+        :return: dictionary of the counters since the start
+        """
+        return {"sent": self.sent, "coalesced": self.coalesced, "failed": self.failed}
+
+
+def tx_from_conf(bus, dbc, sensors_to_dbc, sensors, conf):
+    """
+    :param conf: "tx" dictionary of can.json
+    :return: tx_scheduler
+    """
+    return tx_scheduler(
+        bus, dbc, sensors_to_dbc, sensors,
+        period=conf.get("period_ms", 100) / 1000,
+        periods={name: ms / 1000 for name, ms in conf.get("periods_ms", {}).items()}
+    )
@@ -0,0 +1,121 @@
+"""
+Video FIFO reading: read syscalls per sample and samples per second of the old readers against libs/fifo_reader.py.
+
+ - lines: open(path, 'rb', 0) and "for line in fifo", the first video module loop, one read per byte
+ - chunks: fifo.read(4096) into frame_decoder, a new bytes object per read
+ - fifo_reader: one readv into a reusable 64 KiB buffer per batch
+
+A writer process sends "sensor:value" lines (or binary records) as fast as it can, --lines-per-write at a time. Read
+syscalls are counted from /proc/self/io of the reader process.
+
+Usage: python3 bench/fifo_bench.py [--samples N] [--lines-per-write K] [--fifo-format text|binary32|binary64]
+"""
+import os, sys, tempfile, argparse
+from time import perf_counter
+from multiprocessing import Process
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from framing import frame_encoder, frame_decoder
+from fifo_reader import fifo_reader
+
+
+SENSORS = ("speed", "distance", "power", "heartrate", "cadence", "gear")
+
+
+def read_syscalls():
+    with open("/proc/self/io") as file:
+        for line in file:
+            if line.startswith("syscr:"):
+                return int(line.split()[1])
+
+
+def writer(path, fifo_format, samples, lines_per_write):
+    encoder = frame_encoder(fifo_format)
+    fd = os.open(path, os.O_WRONLY)
+    os.write(fd, encoder.header())
+
+    for start in range(0, samples, lines_per_write):
+        os.write(fd, b"".join(encoder.encode(SENSORS[i % len(SENSORS)], i % 1000)
+                              for i in range(start, min(start + lines_per_write, samples))))
+
+    os.close(fd)
+
+
+def read_lines(path):
+    n = 0
+    with open(path, 'rb', 0) as fifo:
+        for line in fifo:
+            sensor, value = line.decode().rstrip().split(":")
+            n += 1
+    return n
+
+
+def read_chunks(path):
+    n = 0
+    decoder = frame_decoder()
+    with open(path, 'rb', 0) as fifo:
+        while True:
+            chunk = fifo.read(4096)
+            if not chunk:
+                break
+            n += len(decoder.feed(chunk))
+    return n
+
+
+def read_fifo_reader(path):
+    n = 0
+    reader = fifo_reader(path, frame_decoder())
+    while True:
+        batch = reader.read_batch()
+        # the writer closed the FIFO
+        if reader.fd is None:
+            break
+        n += len(batch)
+    return n
+
+
+READERS = {"lines": read_lines, "chunks": read_chunks, "fifo_reader": read_fifo_reader}
+
+
+def run(name, args):
+    tmp = tempfile.mkdtemp(prefix="ffs_fifo_bench_")
+    path = os.path.join(tmp, "fifo_to_video")
+    os.mkfifo(path)
+
+    proc = Process(target=writer, args=(path, args.fifo_format, args.samples, args.lines_per_write))
+    proc.start()
+
+    syscalls = read_syscalls()
+    start = perf_counter()
+    n = READERS[name](path)
+    elapsed = perf_counter() - start
+    syscalls = read_syscalls() - syscalls
+
+    proc.join()
+    os.remove(path)
+    os.rmdir(tmp)
+
+    return n, elapsed, syscalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=200_000)
+    parser.add_argument("--lines-per-write", type=int, default=64)
+    parser.add_argument("--fifo-format", default="text", choices=("text", "binary32", "binary64"))
+    args = parser.parse_args()
+
+    print(f"{args.samples} samples, {args.lines_per_write} per write, {args.fifo_format} FIFO")
+    print(f"{'reader':<14}{'samples':>9}{'reads':>10}{'reads/sample':>14}{'samples/s':>12}")
+
+    for name in READERS:
+        # the line loop only knows text
+        if name == "lines" and args.fifo_format != "text":
+            continue
+
+        n, elapsed, syscalls = run(name, args)
+        print(f"{name:<14}{n:>9}{syscalls:>10}{syscalls / max(n, 1):>14.3f}{n / elapsed:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Per-frame Overlay.update_overlay time, one element changed against full redraw.
+
+Usage: python3 bench/overlay_bench.py [--frames N] [--thickness T] [--text-renderer atlas|putText] [--rotation DEG]
+"""
+import os, sys, argparse
+from time import perf_counter
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src.overlay import OverlayElement, Overlay, colors
+
+
+def run_mode_overlay(thickness, text_renderer, rotation=0):
+    elements = {
+        "speed": OverlayElement("speed", unit=" kph", color=colors["red"]),
+        "distance": OverlayElement("distance", unit=" m", color=colors["red"]),
+        "power": OverlayElement("power", unit=" W", color=colors["red"]),
+        "heartrate": OverlayElement("heartrate", unit=" bpm", color=colors["red"]),
+        "cadence": OverlayElement("cadence", unit=" rpm", color=colors["red"]),
+        "gear": OverlayElement("gear", color=colors["red"]),
+    }
+    for i, element in enumerate(elements.values()):
+        element.set_value(100 + i)
+
+    overlay_obj = Overlay(
+        thickness=thickness,
+        text_renderer=text_renderer,
+        rotation=rotation,
+        top_left=[elements["speed"], elements["distance"]],
+        top_right=[elements["heartrate"], elements["power"], elements["cadence"]],
+        bottom_middle=[elements["gear"]]
+    )
+    overlay_obj.update_overlay()
+
+    return elements, overlay_obj
+
+
+def bench(frames, thickness, text_renderer, rotation, full):
+    elements, overlay_obj = run_mode_overlay(thickness, text_renderer, rotation)
+
+    times = []
+    for i in range(frames):
+        elements["power"].set_value(200 + i % 50)
+        if full:
+            overlay_obj.invalidate()
+
+        start = perf_counter()
+        overlay_obj.update_overlay()
+        times.append(perf_counter() - start)
+
+    times.sort()
+    return sum(times) / len(times), times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--thickness", type=int, default=3)
+    parser.add_argument("--text-renderer", default="atlas", choices=("atlas", "putText"))
+    parser.add_argument("--rotation", type=float, default=0)
+    args = parser.parse_args()
+
+    print(f"{'case':<16}{'mean':>10}{'p50':>10}{'p99':>10}")
+    for name, full in (("full redraw", True), ("one changed", False)):
+        mean, p50, p99 = bench(args.frames, args.thickness, args.text_renderer, args.rotation, full)
+        print(f"{name:<16}{mean * 1e3:>8.3f}ms{p50 * 1e3:>8.3f}ms{p99 * 1e3:>8.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
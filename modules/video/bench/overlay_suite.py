@@ -0,0 +1,235 @@
+"""
+Overlay benchmark suite: Overlay.update_overlay over every mode layout, rotation, thickness and number of elements
+changed per frame, OverlayElement set_value/set_time throughput and peak allocation per frame (tracemalloc).
+
+Results are saved as JSON, --compare prints the ratio against a previous run and exits with 1 if any case got slower
+than --threshold, so two commits can be compared on the same machine.
+
+Usage: python3 bench/overlay_suite.py [--rounds N] [--quick] [--save FILE] [--filter SUBSTRING]
+                                      [--compare FILE [--threshold 0.1] [--stat min|median|mean]]
+"""
+import os, sys, json, platform, subprocess, argparse, tracemalloc
+from time import perf_counter
+from statistics import mean, median, stdev, quantiles
+import numpy as np
+import cv2
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import main as video
+from src.overlay import OverlayElement, Overlay, compile_layout
+
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config'))
+
+MODES = ("TEST_MODE", "RUN_MODE", "ENDURANCE_MODE")
+ROTATIONS = (0, 90, 30)
+THICKNESSES = (1, 3, 5)
+# elements changed per frame, None for all of them
+CHANGED = (0, 1, None)
+
+
+def stats(times):
+    """
+    :param times: seconds per call
+    :return: pytest-benchmark like statistics, in seconds
+    """
+    q1, _, q3 = quantiles(times, n=4) if len(times) > 1 else (times[0], None, times[0])
+    return {
+        "min": min(times),
+        "max": max(times),
+        "mean": mean(times),
+        "stddev": stdev(times) if len(times) > 1 else 0,
+        "median": median(times),
+        "iqr": q3 - q1,
+        "ops": 1 / mean(times),
+        "rounds": len(times)
+    }
+
+
+with open(f"{CONFIG_PATH}/video.json") as file:
+    VIDEO_CONF = json.load(file)
+
+
+def make_overlay(mode, rotation, thickness):
+    elements, regions = compile_layout(video.mode_layout(VIDEO_CONF, mode))
+    overlay_obj = Overlay(thickness=thickness, rotation=rotation, **regions)
+
+    # sensors of the elements on screen, in layout order
+    shown = [element.type for element, _, _, _ in overlay_obj.slots if element.type in elements.elements]
+    for i, sensor in enumerate(shown):
+        elements.update(sensor, 10 + i)
+    overlay_obj.update_overlay()
+
+    return elements, overlay_obj, shown
+
+
+def bench_update_overlay(mode, rotation, thickness, changed, rounds):
+    elements, overlay_obj, shown = make_overlay(mode, rotation, thickness)
+    sensors = shown if changed is None else shown[:changed]
+
+    times = []
+    for i in range(rounds):
+        # values always change the text, a 3 digits value every 7 rounds changes the element width too
+        for sensor in sensors:
+            elements.update(sensor, 100 + i if i % 7 == 0 else i % 50)
+
+        start = perf_counter()
+        overlay_obj.update_overlay()
+        times.append(perf_counter() - start)
+
+    return times
+
+
+def peak_allocation(mode, rotation, thickness, changed, rounds):
+    elements, overlay_obj, shown = make_overlay(mode, rotation, thickness)
+    sensors = shown if changed is None else shown[:changed]
+
+    peaks = []
+    tracemalloc.start()
+    for i in range(rounds):
+        for sensor in sensors:
+            elements.update(sensor, 100 + i if i % 7 == 0 else i % 50)
+
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        overlay_obj.update_overlay()
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return max(peaks)
+
+
+def bench_setter(name, rounds):
+    element = OverlayElement("speed", unit=" kph")
+    n = 10000
+
+    if name == "set_value[changed]":
+        values = [str(i % 100 + 0.4) for i in range(n)]
+        call = element.set_value
+    elif name == "set_value[unchanged]":
+        values = ["42.4"] * n
+        call = element.set_value
+    elif name == "set_time":
+        values = [i * 0.5 for i in range(n)]
+        call = element.set_time
+
+    times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        for val in values:
+            call(val)
+        times.append((perf_counter() - start) / n)
+
+    return times
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "commit": commit
+    }
+
+
+def run(args):
+    benchmarks = []
+
+    def add(name, params, times, **extra):
+        if args.filter and args.filter not in name:
+            return
+
+        result = {"name": name, "params": params, "stats": stats(times)}
+        result.update(extra)
+        benchmarks.append(result)
+
+        s = result["stats"]
+        alloc = f"{extra['peak_alloc_bytes'] / 1024:>9.1f} KiB" if "peak_alloc_bytes" in extra else ""
+        print(f"{name:<58}{s['mean'] * 1e6:>10.1f}us{s['median'] * 1e6:>10.1f}us{s['stddev'] * 1e6:>9.1f}us{alloc}")
+
+    print(f"{'case':<58}{'mean':>12}{'median':>12}{'stddev':>11}{'peak alloc':>13}")
+
+    rotations = ROTATIONS[:1] if args.quick else ROTATIONS
+    thicknesses = (3,) if args.quick else THICKNESSES
+
+    for mode in MODES:
+        for rotation in rotations:
+            for thickness in thicknesses:
+                for changed in CHANGED:
+                    n = "all" if changed is None else changed
+                    name = f"update_overlay[{mode}-rot{rotation}-t{thickness}-changed{n}]"
+                    if args.filter and args.filter not in name:
+                        continue
+
+                    params = {"mode": mode, "rotation": rotation, "thickness": thickness, "changed": n}
+                    times = bench_update_overlay(mode, rotation, thickness, changed, args.rounds)
+                    peak = peak_allocation(mode, rotation, thickness, changed, min(args.rounds, 50))
+                    add(name, params, times, peak_alloc_bytes=peak)
+
+    for setter in ("set_value[changed]", "set_value[unchanged]", "set_time"):
+        add(f"OverlayElement.{setter}", {}, bench_setter(setter, max(args.rounds // 20, 5)))
+
+    return {"machine_info": machine_info(), "benchmarks": benchmarks}
+
+
+def compare(results, path, threshold, stat="median"):
+    """
+    :param stat: statistic compared, "min" is the least sensitive to a busy machine
+    :return: number of cases slower than threshold
+    """
+    with open(path) as file:
+        base = {b["name"]: b for b in json.load(file)["benchmarks"]}
+
+    print(f"\n{'case':<58}{'base':>12}{'new':>12}{'ratio':>8}")
+    regressions = 0
+    for b in results["benchmarks"]:
+        old = base.get(b["name"])
+        if old is None:
+            continue
+
+        ratio = b["stats"][stat] / old["stats"][stat]
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = " SLOWER"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = " faster"
+
+        print(f"{b['name']:<58}{old['stats'][stat] * 1e6:>10.1f}us{b['stats'][stat] * 1e6:>10.1f}us"
+              f"{ratio:>8.2f}{mark}")
+
+    print(f"\n{regressions} cases slower than {threshold:.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--quick", action="store_true", help="rotation 0 and thickness 3 only")
+    parser.add_argument("--filter", default=None, help="only the cases whose name contains it")
+    parser.add_argument("--save", default=None, help="JSON file the results are written to")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--stat", default="median", choices=("min", "median", "mean"), help="statistic compared")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=4)
+
+    if args.compare and compare(results, args.compare, args.threshold, args.stat) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Video module on the headless camera backend: run_mode or endurance_mode read a synthetic FIFO fed by another process,
+reports overlay renders per second, CPU time per render and memory of the video module process.
+
+Usage: python3 bench/video_bench.py [--mode RUN_MODE|ENDURANCE_MODE] [--seconds S] [--rate R] [--max-fps F]
+                                    [--fifo-format text|binary32|binary64] [--tracemalloc] [--render-process]
+       rate is samples per second for every overlay sensor, with --render-process the overlay is rendered by
+       src/render_worker.py and the CPU of the worker is reported apart
+"""
+import os, sys, json, random, tempfile, argparse, resource, tracemalloc
+from time import sleep, monotonic, process_time
+from threading import Thread
+from multiprocessing import Process
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from src import main as video
+from src.overlay import Overlay, compile_layout
+from src.camera import HeadlessBackend
+from src.render_worker import RenderWorker
+from src.endurance_stats import EnduranceStats, StatsFeeder
+
+from log import log
+from framing import frame_encoder
+
+
+CONFIG_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'config'))
+SENSORS = ("speed", "distance", "power", "heartrate", "cadence", "gear")
+
+
+def fifo_writer(path, rate, seconds, fifo_format):
+    # same shape as the CAN module vid_writer: header once, then one record per sample
+    encoder = frame_encoder(fifo_format)
+    with open(path, "wb", 0) as fifo:
+        fifo.write(encoder.header())
+
+        start = monotonic()
+        i = 0
+        while monotonic() - start < seconds:
+            for sensor in SENSORS:
+                fifo.write(encoder.encode(sensor, random.uniform(0, 100)))
+            i += 1
+
+            wait = start + i / rate - monotonic()
+            if wait > 0:
+                sleep(wait)
+
+
+def process_cpu(pid):
+    """
+    :return: user + system CPU seconds of another process
+    """
+    with open(f"/proc/{pid}/stat") as file:
+        fields = file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", default="RUN_MODE", choices=("RUN_MODE", "ENDURANCE_MODE"))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--rate", type=float, default=50)
+    parser.add_argument("--max-fps", type=float, default=None, help="default: video.json overlay max_fps")
+    parser.add_argument("--fifo-format", default="text", choices=("text", "binary32", "binary64"))
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace the Python heap, slows everything down")
+    parser.add_argument("--render-process", action="store_true", help="render in a worker process, default: video.json")
+    args = parser.parse_args()
+
+    log.configure(level="warn")
+
+    with open(f"{CONFIG_PATH}/video.json") as file:
+        video_conf = json.load(file)
+    overlay_conf = video_conf["overlay"]
+
+    tmp = tempfile.mkdtemp(prefix="ffs_video_bench_")
+    fifo_path = os.path.join(tmp, "fifo_to_video")
+    os.mkfifo(fifo_path)
+
+    camera = HeadlessBackend()
+    layout = video.mode_layout(video_conf, args.mode)
+    elements, regions = compile_layout(layout)
+
+    overlay_kwargs = {
+        "screen_width": video_conf["screen"]["width"],
+        "screen_height": video_conf["screen"]["height"],
+        "thickness": overlay_conf["thickness"],
+        "rotation": overlay_conf["rotation"],
+        "text_renderer": overlay_conf.get("text_renderer", "atlas")
+    }
+
+    overlay_obj = None
+    worker = None
+    if args.render_process or overlay_conf.get("render_process", False):
+        worker = RenderWorker(overlay_kwargs, layout)
+        worker.start()
+    else:
+        overlay_obj = Overlay(**overlay_kwargs, **regions)
+
+    scheduler = video.RenderScheduler(camera, overlay_obj, elements,
+                                      max_fps=args.max_fps or overlay_conf.get("max_fps", 15), worker=worker)
+    scheduler.start()
+
+    if args.mode == "RUN_MODE":
+        Thread(target=video.run_mode, args=(scheduler, fifo_path), daemon=True).start()
+    else:
+        # same as the video module, the derived elements are computed for every batch
+        feeder = StatsFeeder(scheduler, EnduranceStats())
+        Thread(target=video.endurance_mode, args=(feeder, fifo_path), daemon=True).start()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    writer = Process(target=fifo_writer, args=(fifo_path, args.rate, args.seconds, args.fifo_format))
+    writer.start()
+
+    start = monotonic()
+    cpu_start = process_time()
+    worker_cpu_start = process_cpu(worker.process.pid) if worker is not None else 0
+    renders_start = scheduler.stats()["renders"]
+
+    writer.join()
+
+    elapsed = monotonic() - start
+    cpu = process_time() - cpu_start
+    stats = scheduler.stats()
+    renders = stats["renders"] - renders_start
+
+    print(f"{args.mode}, {args.rate:.0f} samples/s per sensor, {args.fifo_format} FIFO, {elapsed:.1f}s")
+    print(f"samples            {stats['updates']}, {stats['unchanged']} unchanged, {stats['coalesced']} coalesced")
+    print(f"overlay fps        {renders / elapsed:.1f}")
+    print(f"CPU                {cpu / elapsed * 100:.1f}% of a core, {cpu / max(renders, 1) * 1e3:.2f}ms per render")
+    if worker is not None:
+        worker_cpu = process_cpu(worker.process.pid) - worker_cpu_start
+        print(f"render worker CPU  {worker_cpu / elapsed * 100:.1f}% of a core, "
+              f"{worker_cpu / max(renders, 1) * 1e3:.2f}ms per render")
+    print(f"max RSS            {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"Python heap        {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB")
+
+    # same order as the video module: no render may be in progress when the worker goes away
+    scheduler.stop(timeout=1)
+    if worker is not None:
+        worker.stop()
+
+    os.remove(fifo_path)
+    os.rmdir(tmp)
+
+
+if __name__ == '__main__':
+    main()
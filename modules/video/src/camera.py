@@ -0,0 +1,124 @@
+import os
+from time import sleep
+
+
+class PicameraBackend:
+    """
+    camera preview on the DRM display, with the overlay on top, picamera2 and libcamera are only imported by start()
+    :param video_conf: video.json dictionary
+    :param camera_conf: camera.json dictionary
+    """
+    def __init__(self, video_conf, camera_conf):
+        self.video_conf = video_conf
+        self.camera_conf = camera_conf
+        self.picam = None
+
+    def start(self):
+        import libcamera
+        from picamera2 import Picamera2, Preview
+
+        video_conf = self.video_conf
+        cam_conf = self.camera_conf[video_conf["camera_name"]]
+
+        self.picam = Picamera2()
+
+        preview_config = self.picam.create_preview_configuration(
+            # main video stream parameters
+            main = {'size': (
+                cam_conf["main_stream"]["width"],
+                cam_conf["main_stream"]["height"]
+            )},
+
+            # raw video stream from camera sensor (chosen with rpicam-hello)
+            raw = {
+                'format': cam_conf["raw_stream"]["format"],
+                'size': (
+                    cam_conf["raw_stream"]["size"]["width"],
+                    cam_conf["raw_stream"]["size"]["height"]
+                )
+            },
+
+            # transform parameters
+            transform = libcamera.Transform(
+                hflip=video_conf["hflip"],
+                vflip=video_conf["vflip"]
+            )
+        )
+        self.picam.configure(preview_config)
+
+        self.picam.start_preview(
+            Preview.DRM,
+            x=0, y=0,
+            width=video_conf["screen"]["width"],
+            height=video_conf["screen"]["height"]
+        )
+        self.picam.start()
+
+        sleep(1)
+
+    def set_overlay(self, overlay):
+        self.picam.set_overlay(overlay)
+
+    def stop(self):
+        self.picam.stop()
+        self.picam.stop_preview()
+
+
+class HeadlessBackend:
+    """
+    no camera and no display, the overlays are copied into a ring of frames in memory or, with path, into a memory
+    mapped file that another process can look at, used to run and profile the video module off the Pi
+    :param path: file of the latest overlay frame, raw RGBA of the overlay shape, None to keep the frames in memory
+    :param keep: frames kept in memory
+    """
+    def __init__(self, path=None, keep=1):
+        self.path = path
+        self.keep = keep
+
+        self.frames = None
+        self.count = 0
+
+    def start(self):
+        pass
+
+    def set_overlay(self, overlay):
+        if self.frames is None:
+            # numpy is imported by the overlay anyway, not by the module start
+            import numpy as np
+
+            if self.path is not None:
+                self.frames = [np.memmap(os.path.expanduser(self.path), dtype=overlay.dtype, mode="w+",
+                                         shape=overlay.shape)]
+            else:
+                self.frames = [np.empty_like(overlay) for _ in range(self.keep)]
+
+        self.frames[self.count % len(self.frames)][...] = overlay
+        self.count += 1
+
+    def latest(self):
+        """
+        :return: the last overlay frame received, None before the first one
+        """
+        if self.count == 0:
+            return None
+        return self.frames[(self.count - 1) % len(self.frames)]
+
+    def stop(self):
+        if self.path is not None and self.frames is not None:
+            self.frames[0].flush()
+
+
+def open_camera(video_conf, camera_conf):
+    """
+    :param video_conf: video.json dictionary, "camera_backend" is "picamera2" or "headless"
+    :param camera_conf: camera.json dictionary
+    :return: backend object with start, set_overlay and stop methods
+    """
+    backend = video_conf.get("camera_backend", "picamera2")
+
+    if backend == "picamera2":
+        return PicameraBackend(video_conf, camera_conf)
+    if backend == "headless":
+        return HeadlessBackend(video_conf.get("headless_output"))
+
+    raise ValueError(f"unknown camera backend {backend}")
@@ -0,0 +1,200 @@
+import os, sys
+from math import floor
+from threading import Lock
+from time import monotonic
+
+import numpy as np
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+class EnduranceStats:
+    """
+    live statistics of an hour record attempt, every sample costs O(1) and the memory does not grow with the run:
+    averages are time integrals of the latest value, power is also resampled in one second bins, the last window of
+    them in a ring buffer, for the rolling and the normalized power (4th root of the mean 4th power of the rolling
+    power, over the bins after the first window)
+    :param window: seconds of the rolling power
+    :param duration: seconds of the attempt, for the projected distance
+    :param hold: seconds a value is held after its last sample, the gap after it counts as no data, e.g. a power meter
+                 that went to sleep
+    :param speed_sensor: sensor name of the speed in kph
+    :param power_sensor: sensor name of the power in W
+    :param distance_sensor: sensor name of the distance in m, the speed integral is used without it
+    """
+    def __init__(self, window=30, duration=3600, hold=5, speed_sensor="speed", power_sensor="power",
+                 distance_sensor="distance"):
+        self.window = window
+        self.duration = duration
+        self.hold = hold
+        self.speed_sensor = speed_sensor
+        self.power_sensor = power_sensor
+        self.distance_sensor = distance_sensor
+
+        # time of the first advance, the run starts there
+        self.start = None
+        self.now = None
+
+        # sensor -> [latest value, time of the latest sample]
+        self.latest = {}
+        # sensor -> [integral of the value over time, seconds with a value]
+        self.integrals = {speed_sensor: [0.0, 0.0], power_sensor: [0.0, 0.0]}
+
+        # power bins: index of the open one since the start and its energy so far
+        self.bin = 0
+        self.bin_energy = 0.0
+
+        self.ring = np.zeros(window, dtype=np.float64)
+        self.ring_pos = 0
+        self.ring_filled = 0
+        self.ring_sum = 0.0
+
+        # normalized power: sum of the rolling power to the 4th and number of bins in it
+        self.sum4 = 0.0
+        self.count4 = 0
+
+    def _close_bin(self, power):
+        """
+        pushes the mean power of a second into the ring buffer
+        """
+        self.ring_sum += power - self.ring[self.ring_pos]
+        self.ring[self.ring_pos] = power
+        self.ring_pos = (self.ring_pos + 1) % self.window
+        self.ring_filled = min(self.ring_filled + 1, self.window)
+
+        # the running sum drifts over hours of additions and subtractions, it is summed again once per window
+        if self.ring_pos == 0:
+            self.ring_sum = float(self.ring.sum())
+
+        if self.ring_filled == self.window:
+            self.sum4 += (self.ring_sum / self.window) ** 4
+            self.count4 += 1
+
+    def _integrate(self, sensor, t0, t1):
+        """
+        :return: integral of the held value of sensor between t0 and t1, seconds with a value
+        """
+        latest = self.latest.get(sensor)
+        if latest is None:
+            return 0.0, 0.0
+
+        value, time = latest
+        covered = max(min(t1, time + self.hold) - max(t0, time), 0.0)
+        return value * covered, covered
+
+    def advance(self, now):
+        """
+        integrates the held values up to now and closes the power bins that ended
+        :param now: monotonic seconds
+        """
+        if self.start is None:
+            self.start = now
+            self.now = now
+            return
+        if now <= self.now:
+            return
+
+        for sensor, integral in self.integrals.items():
+            area, covered = self._integrate(sensor, self.now, now)
+            integral[0] += area
+            integral[1] += covered
+
+        power = self.latest.get(self.power_sensor)
+        held_until = power[1] + self.hold if power is not None else float("-inf")
+
+        t = self.now
+        end_bin = floor(now - self.start)
+        while self.bin < end_bin:
+            bin_end = self.start + self.bin + 1
+            self.bin_energy += self._integrate(self.power_sensor, t, bin_end)[0]
+            self._close_bin(self.bin_energy)
+            self.bin += 1
+            self.bin_energy = 0.0
+            t = bin_end
+
+            # a long gap without power: once the ring holds only empty bins, the other ones are counted at once
+            if t >= held_until and self.ring_filled == self.window and not self.ring.any():
+                self.count4 += end_bin - self.bin
+                self.bin = end_bin
+                t = self.start + end_bin
+
+        self.bin_energy += self._integrate(self.power_sensor, t, now)[0]
+        self.now = now
+
+    def add(self, sensor, value, now):
+        """
+        :param sensor: sensor name, the ones not used by the statistics are ignored
+        :param value: new value
+        :param now: monotonic seconds
+        """
+        if sensor not in (self.speed_sensor, self.power_sensor, self.distance_sensor):
+            return
+
+        self.advance(now)
+        self.latest[sensor] = [float(value), now]
+
+    def values(self):
+        """
+        :return: dictionary of the DERIVED values at the last advance, None for the ones without data yet
+        """
+        def average(sensor):
+            area, covered = self.integrals[sensor]
+            return area / covered if covered > 0 else None
+
+        avg_speed = average(self.speed_sensor)
+
+        projected_distance = None
+        if avg_speed is not None:
+            elapsed = self.now - self.start
+            distance = self.latest.get(self.distance_sensor)
+            # kph to m
+            distance = distance[0] if distance is not None else self.integrals[self.speed_sensor][0] / 3.6
+            projected_distance = distance + avg_speed / 3.6 * max(self.duration - elapsed, 0)
+
+        return {
+            "avg_speed": avg_speed,
+            "avg_power": average(self.power_sensor),
+            "power_30s": self.ring_sum / self.ring_filled if self.ring_filled > 0 else None,
+            "normalized_power": (self.sum4 / self.count4) ** 0.25 if self.count4 > 0 else None,
+            "projected_distance": projected_distance
+        }
+
+
+class StatsFeeder:
+    """
+    RenderScheduler front of ENDURANCE_MODE: the samples go to the EnduranceStats and to the scheduler, together with
+    the derived values, recomputed once per batch. The time thread updates every half second, so the derived values
+    keep moving without samples
+    :param scheduler: RenderScheduler
+    :param stats: EnduranceStats
+    """
+    def __init__(self, scheduler, stats):
+        self.scheduler = scheduler
+        self.stats = stats
+        # FIFO, time and telemetry store threads
+        self.lock = Lock()
+
+    def update(self, type, val, origin=None):
+        self.update_batch(((type, val, origin),))
+
+    def update_batch(self, samples):
+        """
+        :param samples: iterable of (sensor name, new value, origin) tuples, as in RenderScheduler.update_batch
+        """
+        samples = list(samples)
+        now = monotonic()
+
+        with self.lock:
+            for type, val, _ in samples:
+                try:
+                    self.stats.add(type, val, now)
+                except Exception as e:
+                    log.err(f"ENDURANCE STATS: {type} {e}", every=1, key=type)
+
+            self.stats.advance(now)
+            derived = self.stats.values()
+
+            # under the lock, derived values of an older batch never overwrite the ones of a newer one
+            self.scheduler.update_batch(samples + [(name, value, None) for name, value in derived.items()])
@@ -1,20 +1,21 @@
 import os, sys, stat
-from signal import pause
-from time import sleep, time
-from threading import Thread
+from signal import pause, signal, SIGTERM
+from time import sleep, time, monotonic
+from threading import Thread, Condition
+from importlib import import_module
 
-import libcamera
-from picamera2 import Picamera2, Preview
-
-from .overlay import OverlayElement, Overlay, colors
-
-import numpy as np
+from .camera import open_camera
 
 import json
 
 # append into path the libs folder, so that Python will find them
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
 from log import log
+from framing import frame_decoder
+from fifo_reader import fifo_reader
+from telemetry_store import telemetry_store
+from tracing import trace
+from startup import startup
 
 
 # useful paths as strings
@@ -26,172 +27,325 @@ config_path = f"{ffs_path}/config"
 FIFO_TO_VIDEO = "fifo_to_video"
 FIFO = f"{home_path}/bob/{FIFO_TO_VIDEO}"
 
-if os.path.exists(FIFO):
-    if not stat.S_ISFIFO(os.stat(FIFO).st_mode):
-        os.remove(FIFO)
-        os.mkfifo(FIFO)
-else:
-    os.mkfifo(FIFO)
+# latest value table written by the CAN module
+TELEMETRY_STORE = f"{home_path}/bob/telemetry"
 
 
-# overlay elements declaration
-speed = OverlayElement("speed", unit=" kph", color=colors["red"])
-distance = OverlayElement("distance", unit=" m", color=colors["red"])
-power = OverlayElement("power", unit=" W", color=colors["red"])
-heartrate = OverlayElement("heartrate", unit=" bpm", color=colors["red"])
-cadence = OverlayElement("cadence", unit=" rpm", color=colors["red"])
-gear = OverlayElement("gear", color=colors["red"])
+def make_fifo(path):
+    """
+    creates the FIFO, replacing any other file with the same path
+    """
+    if os.path.exists(path):
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            os.remove(path)
+            os.mkfifo(path)
+    else:
+        os.mkfifo(path)
 
-test_overlay = OverlayElement("test", val="TEST", color=colors["red"])
 
-time_elapsed = OverlayElement("time", color=colors["red"])
+# overlay of a mode without a layout in video.json, the layouts are only declared there
+FALLBACK_LAYOUT = [
+    {"sensor": "speed", "region": "top_left", "unit": " kph", "color": "red"},
+    {"sensor": "power", "region": "top_right", "unit": " W", "color": "red"}
+]
 
 
-def generate_overlay_positioning(MODE):
-    if MODE == "ENDURANCE_MODE":
-        top_left_overlay = [time_elapsed, speed, distance]
-        top_right_overlay = [heartrate, power, cadence]
-        bottom_middle_overlay = [gear]
-        bottom_right_overlay = []
-        bottom_left_overlay = []
-    else:
-        top_left_overlay = [speed, distance]
-        top_right_overlay = [heartrate, power, cadence]
-        bottom_middle_overlay = [gear]
-        bottom_right_overlay = []
-        bottom_left_overlay = []
-
-    if MODE == "TEST_MODE":
-        top_middle_overlay = [test_overlay]
-    else:
-        top_middle_overlay = []
-
-    return {
-        "top_left_overlay": top_left_overlay,
-        "top_middle_overlay": top_middle_overlay,
-        "top_right_overlay": top_right_overlay,
-        "bottom_left_overlay": bottom_left_overlay,
-        "bottom_middle_overlay": bottom_middle_overlay,
-        "bottom_right_overlay": bottom_right_overlay
-    }
+def mode_layout(video_conf, mode):
+    """
+    :param video_conf: video.json dictionary
+    :param mode: mode name
+    :return: "layouts" entry of the mode, FALLBACK_LAYOUT if there is none
+    """
+    layout = video_conf.get("layouts", {}).get(mode)
+    if layout is None:
+        log.warn(f"VIDEO - no {mode} layout in video.json, showing speed and power only")
+        return FALLBACK_LAYOUT
 
+    return layout
+
+
+class RenderScheduler:
+    """
+    the only place where the overlay is rendered: updates mark it dirty and a render thread redraws it at most max_fps
+    times per second, all the updates received in the meantime are coalesced into a single render, updates that do not
+    change the text of an element do not mark it dirty
+    :param camera: camera backend (see camera.py)
+    :param overlay_obj: overlay object created in the main function, None with worker
+    :param elements: ElementRegistry with the elements of overlay_obj
+    :param max_fps: maximum overlay renders per second
+    :param stats_interval: seconds between two counters logs
+    :param worker: RenderWorker (see render_worker.py) rendering the overlay in its own process instead of overlay_obj,
+                   the lock is then held only to send it the element values
+    """
+    def __init__(self, camera, overlay_obj, elements, max_fps=15, stats_interval=60, worker=None):
+        self.camera = camera
+        self.overlay_obj = overlay_obj
+        self.elements = elements
+        self.worker = worker
+        self.period = 1 / max_fps
+        self.stats_interval = stats_interval
+
+        # guards the overlay elements, FIFO and time threads update them while the render thread reads them
+        self.cond = Condition()
+        self.dirty = False
+
+        self.updates = 0
+        self.renders = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+        # sensor -> reception time of the latest sample not rendered yet, only when tracing
+        self.origins = {}
+
+        self.thread = None
+        self.stopped = False
+
+    def update(self, type, val, origin=None):
+        """
+        updates an overlay element and schedules a render
+        :param type: sensor name
+        :param val: new value
+        :param origin: monotonic nanoseconds of the CAN frame reception, for tracing
+        """
+        self.update_batch(((type, val, origin),))
+
+    def update_batch(self, samples):
+        """
+        updates many overlay elements under one lock, the render thread is woken at most once
+        :param samples: iterable of (sensor name, new value, origin) tuples, origin as in update
+        """
+        with self.cond:
+            changed = False
+
+            for type, val, origin in samples:
+                self.updates += 1
+
+                try:
+                    if not self.elements.update(type, val):
+                        self.unchanged += 1
+                        continue
+                except Exception as e:
+                    log.err(f"RENDER SCHEDULER: {type} {e}", every=1, key=type)
+                    continue
+
+                if origin is not None and trace.enabled:
+                    self.origins[type] = origin
+
+                if self.dirty or changed:
+                    self.coalesced += 1
+                changed = True
+
+            if changed and not self.dirty:
+                self.dirty = True
+                self.cond.notify()
+
+    def stats(self):
+        """
+        :return: dictionary of the scheduler counters
+        """
+        with self.cond:
+            return {
+                "updates": self.updates,
+                "renders": self.renders,
+                "coalesced": self.coalesced,
+                "unchanged": self.unchanged,
+                "unknown": dict(self.elements.unknown)
+            }
+
+    def run(self):
+        last_render = 0
+        last_stats = monotonic()
+
+        while True:
+            with self.cond:
+                while not self.dirty and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+
+            wait = last_render + self.period - monotonic()
+            if wait > 0:
+                sleep(wait)
 
-def test_mode(picam, overlay_obj):
+            try:
+                with self.cond:
+                    self.dirty = False
+                    if self.worker is None:
+                        overlay = self.overlay_obj.update_overlay()
+                    else:
+                        self.worker.submit(self.elements)
+                    self.renders += 1
+
+                    origins = self.origins
+                    if len(origins) > 0:
+                        self.origins = {}
+
+                # the worker renders while the FIFO and time threads keep updating the elements
+                if self.worker is not None:
+                    overlay = self.worker.collect()
+
+                if len(origins) > 0:
+                    now = trace.now()
+                    for sensor, origin in origins.items():
+                        trace.record("render", sensor, origin, now)
+
+                self.camera.set_overlay(overlay)
+
+                if self.renders == 1:
+                    startup.mark("first_frame")
+                    log.info(f"RENDER SCHEDULER - first frame, startup milestones: {startup.milestones}")
+
+                if len(origins) > 0:
+                    now = trace.now()
+                    for sensor, origin in origins.items():
+                        trace.record("display", sensor, origin, now)
+            except Exception as e:
+                log.err(f"RENDER SCHEDULER: {e}")
+
+            last_render = monotonic()
+
+            if last_render - last_stats >= self.stats_interval:
+                stats = self.stats()
+                log.info(f"RENDER SCHEDULER: {stats['renders']} renders, {stats['coalesced']} updates coalesced, "
+                         f"{stats['unchanged']} unchanged, unknown sensors {stats['unknown']}")
+                last_stats = last_render
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        stops the render thread after the render in progress, if any, to be called before stopping the worker or the
+        camera the renders go to
+        :param timeout: seconds waited for the render thread
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+def test_mode(scheduler):
     """
     changes every data in the overlay from 0 to 10
-    :param picam: Picamera2 object
-    :param overlay_obj: overlay object created in the main function
+    :param scheduler: RenderScheduler object created in the main function
     """
 
     while True:
         for i in range(11):
-            speed.set_value(i)
-            distance.set_value(i)
-            power.set_value(i)
-            heartrate.set_value(i)
-            cadence.set_value(i)
-            gear.set_value(i)
-            overlay = overlay_obj.update_overlay()
-            picam.set_overlay(overlay)
+            for type in ("speed", "distance", "power", "heartrate", "cadence", "gear"):
+                scheduler.update(type, i)
             #log.info("VIDEO - Overlay in progress")
             sleep(1)
 
 
-def update_values(type, val):
-    if type == "speed":
-        speed.set_value(val)
-
-    elif type == "distance":
-        distance.set_value(val)
-
-    elif type == "power":
-        power.set_value(val)
+def run_mode(scheduler, fifo_path=FIFO):
+    """
+    takes FIFO_TO_VIDEO as asynchronous data source and updates the overlay
+    :param scheduler: RenderScheduler object created in the main function
+    :param fifo_path: video FIFO path
+    """
+    log.info(f"RUN MODE STARTED")
+    reader = fifo_reader(fifo_path, frame_decoder(), on_open=lambda path: log.info(f"RUN MODE - {path} opened"))
 
-    elif type == "heartrate":
-        heartrate.set_value(val)
+    while True:
+        try:
+            # every sample the writer queued since the last read, applied with a single render
+            batch = reader.read_batch()
+        except Exception as e:
+            log.err(f"RUN MODE: {e}")
+            reader.close()
+            sleep(1)
+            continue
 
-    elif type == "cadence":
-        cadence.set_value(val)
+        if len(batch) == 0:
+            continue
 
-    elif type == "gear":
-        if val == "0":
-            gear.set_value(None)
-        gear.set_value(val)
+        for sensor, value, origin in batch:
+            log.info(f"RUN MODE, READING - {sensor}: {value}", every=1, key=sensor)
+            if trace.enabled:
+                trace.record("parse", sensor, origin)
 
-    elif type == "time":
-        time_elapsed.set_time(val)
+        scheduler.update_batch(batch)
 
 
-def run_mode(picam, overlay_obj):
+def store_reader(scheduler, refresh_rate):
     """
-    takes FIFO_TO_VIDEO as asynchronous data source and updates the overlay
-    :param picam: Picamera2 object
-    :param overlay_obj: overlay object created in the main function
+    reads the latest values from the telemetry store at the given rate, samples overwritten before being read are never
+    rendered
+    :param scheduler: RenderScheduler object created in the main function
+    :param refresh_rate: store reads per second
     """
-    log.info(f"RUN MODE STARTED")
-
-    while True:
+    store = None
+    while store is None:
         try:
-            with open(FIFO, 'rb', 0) as fifo:
-                log.info(f"RUN MODE - {FIFO} opened")
-
-                for line in fifo:
-                    log.info(f"RUN MODE, READING - {line.decode()}")
-                    try:    
-                        sensor, value = line.decode().rstrip().split(":")
-                        log.info(f"{sensor}: {value}")
-                        update_values(sensor, value)
-                        overlay = overlay_obj.update_overlay()
-                        picam.set_overlay(overlay)
-                    except Exception as e:
-                        log.err(f"RUN MODE: {e}")
+            store = telemetry_store(TELEMETRY_STORE)
         except Exception as e:
-            log.err(f"RUN MODE: {e}")
+            log.warn(f"STORE READER: {e}, retrying...")
+            sleep(1)
+
+    log.info(f"STORE READER - {TELEMETRY_STORE} opened")
+
+    while True:
+        for sensor, value, origin in store.read_changed():
+            try:
+                if trace.enabled:
+                    trace.record("parse", sensor, origin)
+                scheduler.update(sensor, value, origin)
+            except Exception as e:
+                log.err(f"STORE READER: {e}")
 
+        sleep(1 / refresh_rate)
 
-def time_sending(picam, overlay_obj):
+
+def time_sending(scheduler):
     start_time = time()
 
     while True:
         actual_time = time() - start_time
-        update_values("time", actual_time)
+        scheduler.update("time", actual_time)
 
-        log.info(f"TIME SENDING: {actual_time}")
+        log.debug(f"TIME SENDING: {actual_time}", every=10)
 
-        overlay = overlay_obj.update_overlay()
-        picam.set_overlay(overlay)
         sleep(0.5)
 
 
-def endurance_mode(picam, overlay_obj):
+def endurance_mode(scheduler, fifo_path=FIFO):
     """
     takes FIFO_TO_VIDEO as asynchronous data source and updates the overlay,
     with time elapsed
-    :param picam: Picamera2 object
-    :param overlay_obj: overlay object created in the main function
+    :param scheduler: RenderScheduler object created in the main function
+    :param fifo_path: video FIFO path
     """
     log.info(f"ENDURANCE MODE STARTED")
 
-    thread_time_sending = Thread(target=time_sending, args=(picam, overlay_obj,))
+    thread_time_sending = Thread(target=time_sending, args=(scheduler,), daemon=True)
     thread_time_sending.start()
 
+    reader = fifo_reader(fifo_path, frame_decoder(), on_open=lambda path: log.info(f"ENDURANCE MODE - {path} opened"))
+
     while True:
         try:
-            with open(FIFO, 'rb', 0) as fifo:
-                log.info(f"ENDURANCE MODE - {FIFO} opened")
-
-                for line in fifo:
-                    log.info(f"ENDURANCE MODE, READING - {line.decode()}")
-                    try:    
-                        sensor, value = line.decode().rstrip().split(":")
-                        log.info(f"{sensor}: {value}")
-                        update_values(sensor, value)
-                        overlay = overlay_obj.update_overlay()
-                        picam.set_overlay(overlay)
-                    except Exception as e:
-                        log.err(f"ENDURANCE MODE: {e}")
+            # every sample the writer queued since the last read, applied with a single render
+            batch = reader.read_batch()
         except Exception as e:
             log.err(f"ENDURANCE MODE: {e}")
+            reader.close()
+            sleep(1)
+            continue
+
+        if len(batch) == 0:
+            continue
+
+        for sensor, value, origin in batch:
+            log.info(f"ENDURANCE MODE, READING - {sensor}: {value}", every=1, key=sensor)
+            if trace.enabled:
+                trace.record("parse", sensor, origin)
+
+        scheduler.update_batch(batch)
 
 
 def json_to_dict(path: str):
@@ -210,73 +364,91 @@ def json_to_dict(path: str):
 
 
 def main():
+    trace.configure(name="video")
+    startup.configure(name="video", last="first_frame")
+    startup.mark("imports")
+
     mode_conf = json_to_dict(f"{config_path}/mode.json")
     video_conf = json_to_dict(f"{config_path}/video.json")
     camera_conf = json_to_dict(f"{config_path}/camera.json")
 
     MODE = mode_conf["mode"]
 
-    cam_name = video_conf["camera_name"]
-
-    picam = Picamera2()
-
-    preview_config = picam.create_preview_configuration(
-        # main video stream parameters
-        main = {'size': (
-            camera_conf[cam_name]["main_stream"]["width"],
-            camera_conf[cam_name]["main_stream"]["height"]
-        )},
-
-        # raw video stream from camera sensor (chosen with rpicam-hello)
-        raw = {
-            'format': camera_conf[cam_name]["raw_stream"]["format"],
-            'size': (
-                camera_conf[cam_name]["raw_stream"]["size"]["width"],
-                camera_conf[cam_name]["raw_stream"]["size"]["height"]
-            )
-        },
-
-        # transform parameters
-        transform = libcamera.Transform(
-            hflip=video_conf["hflip"],
-            vflip=video_conf["vflip"]
-        )
-    )
-    picam.configure(preview_config)
-
-    picam.start_preview(
-        Preview.DRM,
-        x=0, y=0,
-        width=video_conf["screen"]["width"],
-        height=video_conf["screen"]["height"]
-    )
-    picam.start()
-
-    sleep(1)
-
-    overlay_pos = generate_overlay_positioning(MODE)
-
-    # overlay declaration
-    overlay_obj = Overlay(
-        video_conf["screen"]["width"],
-        video_conf["screen"]["height"],
-        thickness=video_conf["overlay"]["thickness"],
-        rotation=video_conf["overlay"]["rotation"],
-        top_left=overlay_pos["top_left_overlay"],
-        top_middle=overlay_pos["top_middle_overlay"],
-        top_right=overlay_pos["top_right_overlay"],
-        bottom_left=overlay_pos["bottom_left_overlay"],
-        bottom_middle=overlay_pos["bottom_middle_overlay"],
-        bottom_right=overlay_pos["bottom_right_overlay"]
-    )
-
-    if MODE == "TEST_MODE":
-        test_mode(picam, overlay_obj)
-    elif MODE == "RUN_MODE":
-        # hybrid solution with pipe still in bob
-        run_mode(picam, overlay_obj)
-    elif MODE == "ENDURANCE_MODE":
-        endurance_mode(picam, overlay_obj)
+    make_fifo(FIFO)
+
+    layout = mode_layout(video_conf, MODE)
+    overlay_kwargs = {
+        "screen_width": video_conf["screen"]["width"],
+        "screen_height": video_conf["screen"]["height"],
+        "thickness": video_conf["overlay"]["thickness"],
+        "rotation": video_conf["overlay"]["rotation"],
+        "text_renderer": video_conf["overlay"].get("text_renderer", "atlas")
+    }
+
+    worker = None
+    if video_conf["overlay"].get("render_process", False):
+        # started before the camera, the worker imports cv2 and builds its overlay meanwhile
+        from .render_worker import RenderWorker
+        worker = RenderWorker(overlay_kwargs, layout)
+        worker.start()
+
+    # cv2 and numpy, imported by the overlay, take seconds on the Pi, they are imported while the camera starts
+    overlay_import = Thread(target=import_module, args=(".overlay", __package__))
+    overlay_import.start()
+
+    camera = open_camera(video_conf, camera_conf)
+    camera.start()
+    startup.mark("camera")
+
+    overlay_import.join()
+    from .overlay import Overlay, compile_layout
+
+    elements, regions = compile_layout(layout)
+
+    # overlay declaration, the worker has its own
+    overlay_obj = None
+    if worker is None:
+        overlay_obj = Overlay(**overlay_kwargs, **regions)
+
+    scheduler = RenderScheduler(camera, overlay_obj, elements, max_fps=video_conf["overlay"].get("max_fps", 15),
+                                worker=worker)
+    scheduler.start()
+
+    # what the data sources update
+    updates = scheduler
+    if MODE == "ENDURANCE_MODE":
+        # average, rolling and normalized power, average speed and projected distance, as overlay elements
+        from .endurance_stats import EnduranceStats, StatsFeeder
+        stats_conf = video_conf.get("endurance_stats", {})
+        updates = StatsFeeder(scheduler, EnduranceStats(
+            window=stats_conf.get("window_s", 30),
+            duration=stats_conf.get("duration_s", 3600),
+            hold=stats_conf.get("hold_s", 5)
+        ))
+
+    store_conf = video_conf.get("telemetry_store", {})
+
+    if MODE != "TEST_MODE" and store_conf.get("enabled", False):
+        thread_store_reader = Thread(target=store_reader, args=(updates, store_conf["refresh_rate"],), daemon=True)
+        thread_store_reader.start()
+
+    # systemd stops the module with SIGTERM, it goes through the same shutdown as ctrl-c
+    signal(SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        if MODE == "TEST_MODE":
+            test_mode(updates)
+        elif MODE == "RUN_MODE":
+            # hybrid solution with pipe still in bob
+            run_mode(updates)
+        elif MODE == "ENDURANCE_MODE":
+            endurance_mode(updates)
+    finally:
+        # renders first, then what they go to
+        scheduler.stop(timeout=1)
+        if worker is not None:
+            worker.stop()
+        camera.stop()
 
 
 if __name__ == '__main__':
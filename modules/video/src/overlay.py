@@ -1,6 +1,6 @@
 import numpy as np
 import cv2
-from math import floor
+from math import floor, ceil, gcd
 
 
 colors = {
@@ -11,6 +11,163 @@ colors = {
 }
 
 
+# cv2.putText works in fixed point coordinates with XY_SHIFT fractional bits
+XY_SHIFT = 16
+XY_ONE = 1 << XY_SHIFT
+
+
+class GlyphAtlas:
+    """
+    glyph masks pre-rasterized by cv2.putText for one (font, scale, thickness, color), text is composed by copying
+    them into the frame, with the same result as cv2.putText
+
+    cv2.putText places every glyph at the fixed point sum of the previous advances, so a glyph may start at a
+    fractional pixel and be rasterized differently: masks are kept for every (character, fractional part) pair, built
+    the first time they are needed by rendering the character after the same prefix it has in the text
+    :param font: font type
+    :param font_scale: font dimension
+    :param thickness: font thickness
+    :param color: writing color, with transparency
+    """
+    # printable ASCII, the Hershey fonts have a glyph for every one of them
+    chars = [chr(c) for c in range(32, 127)]
+
+    def __init__(self, font, font_scale, thickness, color):
+        self.font = font
+        self.font_scale = font_scale
+        self.thickness = thickness
+        self.color = color
+
+        self.hscale = round(font_scale * XY_ONE)
+
+        # color as a whole RGBA pixel
+        self.pixel = np.array(color, dtype=np.uint8).view(np.uint32)[0]
+
+        # glyph advances in font units, with scale 1 and no thickness getTextSize returns exactly their sum
+        self.advances = {c: cv2.getTextSize(c, font, 1.0, 0)[0][0] for c in self.chars}
+
+        (_, self.height), self.baseline = cv2.getTextSize("0", font, font_scale, thickness)
+        self.pad = 2 * thickness + 4
+
+        # {(char, fractional part): glyph pixels and bounding box or None if the glyph draws nothing}
+        self.glyphs = {}
+
+        # pixels of the last texts written, overlay values repeat a lot
+        self.texts = {}
+        self.max_texts = 1024
+
+
+    def _render(self, text, width, org):
+        canvas = np.zeros((self.height + self.baseline + 2 * self.pad, width, 4), dtype=np.uint8)
+        cv2.putText(canvas, text, org, self.font, self.font_scale, self.color, self.thickness,
+                    bottomLeftOrigin=False)
+        return canvas.any(axis=2)
+
+
+    def _glyph(self, char, phase, prefix):
+        """
+        :param char: character
+        :param phase: fractional part of the fixed point glyph origin
+        :param prefix: characters written before char, their advance has the given fractional part
+        :return: (ys, xs, x0, y0, x1, y1): glyph pixels and bounding box from the integer glyph origin, None if the
+                 glyph draws nothing
+        """
+        key = (char, phase)
+        if key in self.glyphs:
+            return self.glyphs[key]
+
+        # spaces that move the glyph far enough from the prefix without changing the fractional part, the prefix is
+        # then drawn outside of the canvas, so that only the glyph is left
+        space = self.advances[" "] * self.hscale
+        period = XY_ONE // gcd(space, XY_ONE)
+        spaces = period * max(1, ceil((4 * self.pad) / (period * self.advances[" "] * self.font_scale)))
+        prefix += " " * spaces
+
+        prefix_fixed = sum(self.advances[c] for c in prefix) * self.hscale
+        org = (self.pad - (prefix_fixed >> XY_SHIFT), self.pad + self.height)
+        width = int(self.advances[char] * self.font_scale) + 4 * self.pad
+
+        ys, xs = np.nonzero(self._render(prefix + char, width, org))
+        if len(xs) == 0:
+            glyph = None
+        else:
+            ys = ys - org[1]
+            xs = xs - self.pad
+            glyph = (ys, xs, xs.min(), ys.min(), xs.max() + 1, ys.max() + 1)
+
+        self.glyphs[key] = glyph
+        return glyph
+
+
+    def _compose(self, text, frame_w):
+        """
+        :return: (offsets, x0, y0, x1, y1): text pixels as offsets in the flattened frame and bounding box, both from
+                 the text origin, None if the text draws nothing
+        """
+        offsets = []
+        x0 = y0 = x1 = y1 = 0
+        advance = 0
+
+        for i, char in enumerate(text):
+            phase = advance & (XY_ONE - 1)
+            glyph = self.glyphs[(char, phase)] if (char, phase) in self.glyphs else self._glyph(char, phase, text[:i])
+
+            if glyph is not None:
+                ys, xs, gx0, gy0, gx1, gy1 = glyph
+                x = advance >> XY_SHIFT
+
+                offsets.append(ys * frame_w + (xs + x))
+
+                if len(offsets) == 1:
+                    x0, y0, x1, y1 = gx0 + x, gy0, gx1 + x, gy1
+                else:
+                    x0, y0, x1, y1 = min(x0, gx0 + x), min(y0, gy0), max(x1, gx1 + x), max(y1, gy1)
+
+            advance += self.advances[char] * self.hscale
+
+        if len(offsets) == 0:
+            return None
+
+        return np.concatenate(offsets), x0, y0, x1, y1
+
+
+    def draw(self, frame, text, org):
+        """
+        writes text in frame, same arguments as cv2.putText with bottomLeftOrigin=False
+        :param frame: C-contiguous RGBA frame
+        :return: False if the text can't be composed from the atlas (characters without a glyph or text touching the
+                 frame border), nothing is written in that case
+        """
+        frame_h, frame_w = frame.shape[:2]
+
+        key = (text, frame_w)
+        if key in self.texts:
+            composed = self.texts[key]
+        else:
+            if any(char not in self.advances for char in text):
+                return False
+
+            if len(self.texts) >= self.max_texts:
+                self.texts.clear()
+
+            composed = self._compose(text, frame_w)
+            self.texts[key] = composed
+
+        if composed is None:
+            return True
+
+        offsets, x0, y0, x1, y1 = composed
+
+        # cv2.putText clips lines at the frame border in its own way, leave the text touching it to cv2
+        if org[0] + x0 < 0 or org[1] + y0 < 0 or org[0] + x1 > frame_w or org[1] + y1 > frame_h:
+            return False
+
+        # the text is written with a single indexed assignment of whole RGBA pixels
+        pixels = frame.view(np.uint32).reshape(-1)
+        pixels[offsets + (org[1] * frame_w + org[0])] = self.pixel
+        return True
+
+
 class OverlayElement:
     """
     :param type: type of data (speed, distance, etc...)
@@ -19,6 +176,8 @@ class OverlayElement:
     :param color: color of the writing
     :param transparency: color transparency (255 -> no transparency)
     """
+    __slots__ = ("type", "val", "unit", "color", "text", "raw")
+
     def __init__(self, type, val=None, unit="", color=colors['white'],
                  transparency=255):
         self.type = type
@@ -26,30 +185,119 @@ class OverlayElement:
         self.unit = unit
         self.color = color + (transparency,)
 
+        # text drawn by the overlay, formatted only when the value changes
+        self.text = None if val == None else f"{val}{unit}"
+        # last value received, the same sample sent again is not converted again
+        self.raw = val
+
+    def _set(self, val):
+        """
+        :return: True if the text to draw changed
+        """
+        if val == self.val:
+            return False
+
+        self.val = val
+        self.text = None if val == None else f"{val}{self.unit}"
+        return True
+
     def set_value(self, val):
         """
-        :param val: new value
+        :param val: new value, None to hide the element
+        :return: True if the text to draw changed
         """
-        self.val = round(float(val))
+        if val == self.raw:
+            return False
+        self.raw = val
+
+        return self._set(None if val == None else round(float(val)))
 
 
     def set_time(self, val):
         """
         :param val: time elapsed in seconds
+        :return: True if the text to draw changed
         """
-        mins = floor(float(val / 60))
+        val = float(val)
+        if val == self.raw:
+            return False
+        self.raw = val
+
+        mins = floor(val / 60)
         secs = floor(val % 60)
 
-        min_str = f"{mins}"
-        sec_str = f"{secs}"
+        return self._set(f"{mins:02}:{secs:02}")
+
+
+class ElementRegistry:
+    """
+    overlay elements by the sensor name that updates them
+    :param elements_conf: dictionary of sensor name -> {"unit": str, "color": colors key, "format": "value" or "time"}
+    """
+    def __init__(self, elements_conf):
+        self.elements = {}
+        self.setters = {}
+
+        for sensor, conf in elements_conf.items():
+            element = OverlayElement(sensor, unit=conf.get("unit", ""), color=colors[conf.get("color", "white")])
+            self.elements[sensor] = element
+
+            if conf.get("format", "value") == "time":
+                self.setters[sensor] = element.set_time
+            else:
+                self.setters[sensor] = element.set_value
+
+        # sensor name -> samples received without an element, e.g. the ones not shown in the current mode
+        self.unknown = {}
+
+    def __getitem__(self, sensor):
+        return self.elements[sensor]
 
-        if mins < 10:
-            min_str = f"0{mins}"
+    def update(self, sensor, val):
+        """
+        :param sensor: sensor name
+        :param val: new value
+        :return: True if the text of an element changed and the overlay needs to be rendered
+        """
+        setter = self.setters.get(sensor)
+        if setter == None:
+            self.unknown[sensor] = self.unknown.get(sensor, 0) + 1
+            return False
 
-        if secs < 10:
-            sec_str = f"0{secs}"
+        return setter(val)
 
-        self.val = f"{min_str}:{sec_str}"
+
+REGIONS = ("top_left", "top_middle", "top_right", "bottom_left", "bottom_middle", "bottom_right")
+
+
+def compile_layout(layout):
+    """
+    :param layout: list of {"sensor": name, "region": one of REGIONS, "unit": str, "color": colors key,
+                   "format": "value" or "time"} dictionaries, elements of the same region are drawn top to bottom in
+                   list order, {"text": str, ...} instead of "sensor" for a fixed writing
+    :return: (ElementRegistry of the sensor elements, dictionary region -> list of elements), the second one is meant
+             to be passed to Overlay as keyword arguments
+    """
+    elements_conf = {}
+    for entry in layout:
+        if "sensor" in entry:
+            elements_conf[entry["sensor"]] = entry
+
+    elements = ElementRegistry(elements_conf)
+
+    regions = {region: [] for region in REGIONS}
+    for entry in layout:
+        if entry["region"] not in regions:
+            raise ValueError(f"unknown overlay region {entry['region']}")
+
+        if "sensor" in entry:
+            element = elements[entry["sensor"]]
+        else:
+            element = OverlayElement("text", val=entry["text"], color=colors[entry.get("color", "white")])
+
+        regions[entry["region"]].append(element)
+
+    return elements, regions
 
 
 class Overlay:
@@ -65,6 +313,8 @@ class Overlay:
     :param offset: space between lines
     :param rotation: overlay rotation angle in degrees
     :param font: font type, default cv2.FONT_HERSHEY_SIMPLEX
+    :param text_renderer: "atlas" to compose text from pre-rasterized glyphs (see GlyphAtlas), "putText" to always
+                          use cv2.putText
     :param top_left: ordered list of writings in the top left corner
     :param top_middle: ordered list of writings at the top in the middle
     :param top_right: ordered list of writings in the top right corner
@@ -76,21 +326,38 @@ class Overlay:
                  top_left_org = (10, 50), top_right_org = (1014, 50),
                  bottom_left_org = (10, 570), bottom_right_org = (1014, 570),
                  font_scale=1.5, thickness=4, offset=50, rotation=0,
-                 font = cv2.FONT_HERSHEY_SIMPLEX,
+                 font = cv2.FONT_HERSHEY_SIMPLEX, text_renderer="atlas",
                  top_left=[], top_middle=[], top_right=[],
                  bottom_left=[], bottom_middle=[], bottom_right=[]):
         self.screen_width = screen_width
         self.screen_height = screen_height
-        self.top_left_org = top_left_org
-        self.top_right_org = top_right_org
-        self.bottom_left_org = bottom_left_org
-        self.bottom_right_org = bottom_right_org
+        self.rotation = rotation
+
+        # right angles are applied by transposing the frame, so the layout is done directly on the rotated screen,
+        # with the same margins from its borders
+        self.quarter_turns = (rotation // 90) % 4 if rotation % 90 == 0 else None
+        if self.quarter_turns in (1, 3):
+            self.layout_width, self.layout_height = screen_height, screen_width
+        else:
+            self.layout_width, self.layout_height = screen_width, screen_height
+
+        self.top_left_org = self._layout_org(top_left_org)
+        self.top_right_org = self._layout_org(top_right_org)
+        self.bottom_left_org = self._layout_org(bottom_left_org)
+        self.bottom_right_org = self._layout_org(bottom_right_org)
+        top_left_org, top_right_org = self.top_left_org, self.top_right_org
+        bottom_left_org, bottom_right_org = self.bottom_left_org, self.bottom_right_org
 
         self.font_scale = font_scale
         self.thickness = thickness
         self.offset = offset
-        self.rotation = rotation
         self.font = font
+        self.text_renderer = text_renderer
+
+        # one glyph atlas per color, font, scale and thickness are the same for all the elements
+        self.atlases = {}
+        # text -> (size, baseline) from cv2.getTextSize, values repeat a lot so alignment is mostly a lookup
+        self.extents = {}
 
         self.top_left = top_left
         self.top_middle = top_middle
@@ -107,119 +374,183 @@ class Overlay:
         for i in range(max(len(self.bottom_left), len(self.bottom_right), len(self.bottom_middle))):
             self.bottom_vert_org.append(bottom_left_org[1] - i * offset)
 
-
-    def update_overlay(self):
+        # flat list of (element, alignment, horizontal anchor, vertical origin), in drawing order
+        self.slots = []
+        for region, align, anchor, vert_org in (
+                (self.top_left, "left", top_left_org[0], self.top_vert_org),
+                (self.top_middle, "middle", self.layout_width // 2, self.top_vert_org),
+                (self.top_right, "right", top_right_org[0], self.top_vert_org),
+                (self.bottom_left, "left", bottom_left_org[0], self.bottom_vert_org),
+                (self.bottom_middle, "middle", self.layout_width // 2, self.bottom_vert_org),
+                (self.bottom_right, "right", bottom_right_org[0], self.bottom_vert_org)):
+            for i, element in enumerate(region):
+                self.slots.append((element, align, anchor, vert_org[i]))
+
+        # what is currently drawn in the persistent frame for every slot: message, origin and bounding box
+        self.drawn_msgs = [None] * len(self.slots)
+        self.drawn_orgs = [None] * len(self.slots)
+        self.drawn_boxes = [None] * len(self.slots)
+
+        self.frame = np.zeros((self.layout_height, self.layout_width, 4), dtype=np.uint8)
+
+        # margin around the text size, strokes and antialiasing go slightly beyond it
+        self.box_margin = self.thickness + 2
+
+        # screen areas (x0, y0, x1, y1) of the frame returned by the last update_overlay that changed
+        self.changed = []
+        # the whole frame was cleared, the next update_overlay changes all of it
+        self.cleared = False
+
+        # rotated frame, updated only where the frame changed
+        self.output = None
+        if self.rotation % 360 != 0:
+            self.output = np.zeros((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+
+        if self.quarter_turns == None:
+            # any other angle: the rotation is computed once as remap tables, the same bilinear warpAffine used to do
+            image_center = (self.screen_width / 2, self.screen_height / 2)
+            self.rot_mat = cv2.getRotationMatrix2D(image_center, self.rotation, 1.0)
+
+            inv_mat = cv2.invertAffineTransform(self.rot_mat)
+            xs, ys = np.meshgrid(np.arange(self.screen_width, dtype=np.float32),
+                                 np.arange(self.screen_height, dtype=np.float32))
+            self.map_x = (inv_mat[0, 0] * xs + inv_mat[0, 1] * ys + inv_mat[0, 2]).astype(np.float32)
+            self.map_y = (inv_mat[1, 0] * xs + inv_mat[1, 1] * ys + inv_mat[1, 2]).astype(np.float32)
+
+
+    def _layout_org(self, org):
         """
-        updates overlay by creating a new transparent "frame" on which it writes
-        data by iterating all the position lists (top_left, top_middle, etc...)
-        :return: overlay frame 
+        :param org: origin point on the screen
+        :return: origin point on the (rotated) layout, at the same distance from the nearest borders
         """
-        overlay = np.zeros((self.screen_height, self.screen_width, 4), dtype=np.uint8)
+        x, y = org
+        if x > self.screen_width / 2:
+            x = self.layout_width - (self.screen_width - x)
+        if y > self.screen_height / 2:
+            y = self.layout_height - (self.screen_height - y)
 
-        if len(self.top_left) > 0:
-            for i, element in enumerate(self.top_left):
-                if element.val == None:
-                    continue
+        return (x, y)
 
-                msg = f"{element.val}{element.unit}"
 
-                cv2.putText(
-                    overlay,
-                    msg,
-                    (self.top_left_org[0], self.top_vert_org[i]),
-                    self.font,
-                    self.font_scale,
-                    element.color,
-                    self.thickness,
-                    bottomLeftOrigin=False
-                )
+    def invalidate(self):
+        """
+        forces the next update_overlay to redraw every element
+        """
+        self.frame.fill(0)
+        if self.output is not None:
+            self.output.fill(0)
+        self.cleared = True
+        self.drawn_msgs = [None] * len(self.slots)
+        self.drawn_orgs = [None] * len(self.slots)
+        self.drawn_boxes = [None] * len(self.slots)
 
-        if len(self.top_middle) > 0:
-            for i, element in enumerate(self.top_middle):
-                if element.val == None:
-                    continue
 
-                msg = f"{element.val}{element.unit}"
+    def _layout(self, msg, align, anchor, vert_org):
+        """
+        :return: text origin and bounding box (x0, y0, x1, y1) clipped to the frame
+        """
+        extent = self.extents.get(msg)
+        if extent == None:
+            if len(self.extents) >= 4096:
+                self.extents.clear()
+
+            extent = cv2.getTextSize(
+                msg,
+                self.font,
+                self.font_scale,
+                self.thickness
+            )
+            self.extents[msg] = extent
+
+        elem_dim, baseline = extent
+
+        if align == "middle":
+            x = (self.layout_width - elem_dim[0]) // 2
+        elif align == "right":
+            x = anchor - elem_dim[0]
+        else:
+            x = anchor
+
+        box = (
+            max(x - self.box_margin, 0),
+            max(vert_org - elem_dim[1] - self.box_margin, 0),
+            min(x + elem_dim[0] + self.box_margin, self.layout_width),
+            min(vert_org + baseline + self.box_margin, self.layout_height)
+        )
+
+        return (x, vert_org), box
+
+
+    def _draw_atlas(self, msg, org, color):
+        """
+        :return: False if the message has to be written with cv2.putText
+        """
+        if self.text_renderer != "atlas":
+            return False
 
-                elem_dim, _ = cv2.getTextSize(
-                    msg,
-                    self.font,
-                    self.font_scale,
-                    self.thickness
-                )
-                
-                cv2.putText(
-                    overlay,
-                    msg,
-                    ((self.screen_width - elem_dim[0]) // 2, self.top_vert_org[i]),
-                    self.font,
-                    self.font_scale,
-                    element.color,
-                    self.thickness,
-                    bottomLeftOrigin=False
-                )
+        atlas = self.atlases.get(color)
+        if atlas == None:
+            atlas = GlyphAtlas(self.font, self.font_scale, self.thickness, color)
+            self.atlases[color] = atlas
 
-        if len(self.top_right) > 0:
-            for i, element in enumerate(self.top_right):
-                if element.val == None:
-                    continue
+        return atlas.draw(self.frame, msg, org)
 
-                msg = f"{element.val}{element.unit}"
 
-                elem_dim, _ = cv2.getTextSize(
-                    msg,
-                    self.font,
-                    self.font_scale,
-                    self.thickness
-                )
+    @staticmethod
+    def _overlaps(a, b):
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
 
-                cv2.putText(
-                    overlay,
-                    msg,
-                    (self.top_right_org[0] - elem_dim[0], self.top_vert_org[i]),
-                    self.font,
-                    self.font_scale,
-                    element.color,
-                    self.thickness,
-                    bottomLeftOrigin=False
-                )
 
-        if len(self.bottom_left) > 0:
-            for i, element in enumerate(self.bottom_left):
-                if element.val == None:
+    def update_overlay(self):
+        """
+        updates the persistent overlay frame: only the elements whose text changed since the previous call (and the
+        ones overlapping them) are cleared and redrawn, inside their bounding boxes
+        :return: overlay frame, it is reused by the next update_overlay call
+        """
+        msgs = []
+        for element, _, _, _ in self.slots:
+            msgs.append(element.text)
+
+        dirty = set()
+        new_orgs = {}
+        new_boxes = {}
+        for i, (_, align, anchor, vert_org) in enumerate(self.slots):
+            if msgs[i] != self.drawn_msgs[i]:
+                dirty.add(i)
+                if msgs[i] != None:
+                    new_orgs[i], new_boxes[i] = self._layout(msgs[i], align, anchor, vert_org)
+
+        if len(dirty) == 0:
+            return self._present([])
+
+        # an element touching a cleared or redrawn box has to be redrawn too, until nothing else is touched
+        rects = [self.drawn_boxes[i] for i in dirty if self.drawn_boxes[i] != None]
+        rects += [new_boxes[i] for i in dirty if i in new_boxes]
+
+        grown = True
+        while grown:
+            grown = False
+            for i, box in enumerate(self.drawn_boxes):
+                if i in dirty or box == None:
                     continue
 
-                msg = f"{element.val}{element.unit}"
+                if any(self._overlaps(box, rect) for rect in rects):
+                    dirty.add(i)
+                    new_orgs[i], new_boxes[i] = self.drawn_orgs[i], box
+                    rects.append(box)
+                    grown = True
 
-                cv2.putText(
-                    overlay,
-                    msg,
-                    (self.bottom_left_org[0], self.bottom_vert_org[i]),
-                    self.font,
-                    self.font_scale,
-                    element.color,
-                    self.thickness,
-                    bottomLeftOrigin=False
-                )
-
-        if len(self.bottom_middle) > 0:
-            for i, element in enumerate(self.bottom_middle):
-                if element.val == None:
-                    continue
+        for x0, y0, x1, y1 in rects:
+            self.frame[y0:y1, x0:x1] = 0
 
-                msg = f"{element.val}{element.unit}"
-
-                elem_dim, _ = cv2.getTextSize(
-                    msg,
-                    self.font,
-                    self.font_scale,
-                    self.thickness
-                )
+        for i in sorted(dirty):
+            element = self.slots[i][0]
 
+            if msgs[i] != None and not self._draw_atlas(msgs[i], new_orgs[i], element.color):
                 cv2.putText(
-                    overlay,
-                    msg,
-                    ((self.screen_width - elem_dim[0]) // 2, self.bottom_vert_org[i]),
+                    self.frame,
+                    msgs[i],
+                    new_orgs[i],
                     self.font,
                     self.font_scale,
                     element.color,
@@ -227,35 +558,80 @@ class Overlay:
                     bottomLeftOrigin=False
                 )
 
-        if len(self.bottom_right) > 0:
-            for i, element in enumerate(self.bottom_right):
-                if element.val == None:
-                    continue
+            self.drawn_msgs[i] = msgs[i]
+            self.drawn_orgs[i] = new_orgs.get(i)
+            self.drawn_boxes[i] = new_boxes.get(i)
 
-                msg = f"{element.val}{element.unit}"
+        return self._present(rects)
 
-                elem_dim, _ = cv2.getTextSize(
-                    msg,
-                    self.font,
-                    self.font_scale,
-                    self.thickness
-                )
 
-                cv2.putText(
-                    overlay,
-                    msg,
-                    (self.bottom_right_org[0] - elem_dim[0], self.bottom_vert_org[i]),
-                    self.font,
-                    self.font_scale,
-                    element.color,
-                    self.thickness,
-                    bottomLeftOrigin=False
-                )
-
-        if self.rotation != 0:
-            image_center = tuple(np.array(overlay.shape[1::-1]) / 2)
-            rot_mat = cv2.getRotationMatrix2D(image_center, self.rotation, 1.0)
-            result = cv2.warpAffine(overlay, rot_mat, overlay.shape[1::-1], flags=cv2.INTER_LINEAR)
-            return result
-
-        return overlay
+    def _present(self, rects):
+        """
+        :param rects: frame areas changed by the last update
+        :return: frame to be shown, rotated if needed
+        """
+        if self.output is None:
+            changed = rects
+        else:
+            changed = []
+            for rect in rects:
+                if self.quarter_turns != None:
+                    changed.append(self._rotate_rect(rect))
+                else:
+                    rect = self._warp_rect(rect)
+                    if rect != None:
+                        changed.append(rect)
+
+        if self.cleared:
+            self.cleared = False
+            changed = [(0, 0, self.screen_width, self.screen_height)]
+        self.changed = changed
+
+        return self.frame if self.output is None else self.output
+
+
+    def _rotate_rect(self, rect):
+        """
+        copies a frame area into the output rotated by a multiple of 90 degrees, lossless
+        :return: output area written
+        """
+        x0, y0, x1, y1 = rect
+        w, h = self.layout_width, self.layout_height
+        area = np.rot90(self.frame[y0:y1, x0:x1], self.quarter_turns)
+
+        if self.quarter_turns == 1:
+            self.output[w - x1:w - x0, y0:y1] = area
+            return (y0, w - x1, y1, w - x0)
+        elif self.quarter_turns == 2:
+            self.output[h - y1:h - y0, w - x1:w - x0] = area
+            return (w - x1, h - y1, w - x0, h - y0)
+        else:
+            self.output[x0:x1, h - y1:h - y0] = area
+            return (h - y1, x0, h - y0, x1)
+
+
+    def _warp_rect(self, rect):
+        """
+        warps into the output the screen area covered by a rotated frame area
+        :return: output area written, None if the area is off screen
+        """
+        x0, y0, x1, y1 = rect
+        corners = np.array([[x0, y0, 1], [x1, y0, 1], [x0, y1, 1], [x1, y1, 1]], dtype=np.float64)
+        rotated = corners @ self.rot_mat.T
+
+        # one more pixel on every side for the bilinear interpolation
+        ox0 = max(int(np.floor(rotated[:, 0].min())) - 1, 0)
+        oy0 = max(int(np.floor(rotated[:, 1].min())) - 1, 0)
+        ox1 = min(int(np.ceil(rotated[:, 0].max())) + 2, self.screen_width)
+        oy1 = min(int(np.ceil(rotated[:, 1].max())) + 2, self.screen_height)
+        if ox0 >= ox1 or oy0 >= oy1:
+            return None
+
+        self.output[oy0:oy1, ox0:ox1] = cv2.remap(
+            self.frame,
+            self.map_x[oy0:oy1, ox0:ox1],
+            self.map_y[oy0:oy1, ox0:ox1],
+            cv2.INTER_LINEAR
+        )
+
+        return (ox0, oy0, ox1, oy1)
@@ -0,0 +1,183 @@
+import os, sys
+from multiprocessing import get_context, shared_memory
+
+# append into path the libs folder, so that Python will find them
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'libs')))
+from log import log
+
+
+def render_loop(conn, shm_name, shape, overlay_kwargs, layout):
+    """
+    worker process: owns the Overlay and renders into the frame that is not on screen, the main process is told which
+    one is complete
+    :param conn: Pipe end, receives (request number, frame on screen, {sensor: value}) and answers
+                 (request number, frame rendered)
+    :param shm_name: shared memory of the two frames
+    :param shape: (height, width, 4) of a frame
+    :param overlay_kwargs: keyword arguments of Overlay, without the regions
+    :param layout: layout of the mode, see compile_layout
+    """
+    # cv2 and numpy are imported here, not by the main process when it starts the worker
+    import numpy as np
+    from .overlay import Overlay, compile_layout
+
+    elements, regions = compile_layout(layout)
+    overlay_obj = Overlay(**overlay_kwargs, **regions)
+
+    shm = shared_memory.SharedMemory(shm_name)
+    frames = np.ndarray((2,) + shape, dtype=np.uint8, buffer=shm.buf)
+
+    # screen areas changed since each frame was last written, None when all of it has to be written (first frame or
+    # worker restarted, the frames hold what the previous worker drew)
+    stale = [None, None]
+
+    while True:
+        try:
+            number, front, values = conn.recv()
+        except EOFError:
+            # the main process went away
+            break
+
+        for sensor, val in values.items():
+            try:
+                elements.update(sensor, val)
+            except Exception as e:
+                log.err(f"RENDER WORKER: {sensor} {e}", every=1, key=sensor)
+
+        frame = overlay_obj.update_overlay()
+
+        back = 1 - front
+        for i in (0, 1):
+            if stale[i] is not None:
+                stale[i] += overlay_obj.changed
+                # a frame left behind for long is written whole
+                if len(stale[i]) > 64:
+                    stale[i] = None
+
+        # only the areas that differ from the current frame are copied into the frame behind the screen
+        if stale[back] is None:
+            frames[back][...] = frame
+        else:
+            for x0, y0, x1, y1 in stale[back]:
+                frames[back][y0:y1, x0:x1] = frame[y0:y1, x0:x1]
+        stale[back] = []
+
+        conn.send((number, back))
+
+    del frames
+    shm.close()
+
+
+class RenderWorker:
+    """
+    renders the overlay in a separate process, on another core and out of the GIL of the FIFO, time and picamera2
+    threads: the worker owns the Overlay and renders into two RGBA frames in shared memory, the one on screen is never
+    written, the other one is filled and becomes the frame to show. The main process only sends the values of the
+    elements that changed and gets back the index of the complete frame, frames are neither copied nor pickled
+    :param overlay_kwargs: keyword arguments of Overlay, without the regions, screen_width and screen_height are needed
+    :param layout: layout of the mode, see compile_layout
+    :param timeout: seconds a render is waited for
+    :param start_timeout: seconds the first render of a worker is waited for, it imports cv2 before
+    """
+    def __init__(self, overlay_kwargs, layout, timeout=1.0, start_timeout=10.0):
+        self.overlay_kwargs = overlay_kwargs
+        self.layout = layout
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.shape = (overlay_kwargs["screen_height"], overlay_kwargs["screen_width"], 4)
+
+        # spawned, not forked: the main process already runs the picamera2 threads
+        self.context = get_context("spawn")
+        self.shm = None
+        self.frames = None
+        self.process = None
+        self.conn = None
+
+        # frame on screen, the worker renders into the other one
+        self.front = 0
+        self.number = 0
+        # sensor -> value last sent to the worker
+        self.sent = {}
+        self.restarts = 0
+        # a frame was collected from the current worker
+        self.ready = False
+
+    def start(self):
+        """
+        starts the worker, it imports cv2 and builds its overlay in the background, so it can be started before the
+        camera
+        """
+        if self.shm is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=2 * self.shape[0] * self.shape[1] * self.shape[2])
+
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=render_loop,
+            args=(child_conn, self.shm.name, self.shape, self.overlay_kwargs, self.layout),
+            name="render_worker",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+        # a new worker has none of the values
+        self.sent = {}
+        self.ready = False
+
+    def submit(self, elements):
+        """
+        sends the values changed since the last render, call it while nobody updates elements
+        :param elements: ElementRegistry of the main process
+        """
+        if not self.process.is_alive():
+            log.err(f"RENDER WORKER: exited with code {self.process.exitcode}, restarting")
+            self.conn.close()
+            self.restarts += 1
+            self.start()
+
+        values = {}
+        for sensor, element in elements.elements.items():
+            if element.raw != self.sent.get(sensor):
+                values[sensor] = element.raw
+                self.sent[sensor] = element.raw
+
+        self.number += 1
+        self.conn.send((self.number, self.front, values))
+
+    def collect(self):
+        """
+        waits for the frame of the last submit, it can be passed to set_overlay as it is, it is not written until the
+        next frame is collected
+        :return: RGBA frame in shared memory
+        """
+        if self.frames is None:
+            import numpy as np
+            self.frames = np.ndarray((2,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        timeout = self.timeout if self.ready else self.start_timeout
+        while True:
+            if not self.conn.poll(timeout):
+                raise RuntimeError(f"render worker, no frame in {timeout}s")
+
+            number, back = self.conn.recv()
+            # answers to the renders that timed out are late, the frame they wrote is never shown
+            if number == self.number:
+                break
+
+        self.front = back
+        self.ready = True
+        return self.frames[back]
+
+    def stop(self):
+        if self.process is not None:
+            self.conn.close()
+            self.process.join(self.timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+
+        if self.shm is not None:
+            self.frames = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None